@@ -0,0 +1,242 @@
+# Databricks notebook source
+# DBTITLE 1,Information
+# MAGIC %md
+# MAGIC Generate synthetic archive files and archive log for benchmarking of archive to databricks loaders.
+# MAGIC
+# MAGIC Each generated file is full extract of the dataset. Between consecutive files part of rows change, part of rows are deleted and the same number of new rows is inserted. Optionally new columns appear every N files (schema drift).
+# MAGIC
+# MAGIC Required additional libraries:
+# MAGIC - None
+# MAGIC
+# MAGIC Example call:
+# MAGIC ```
+# MAGIC returnFlag = dbutils.notebook.run(
+# MAGIC   path = "/DataLake/__Library/Benchmark/GenerateSyntheticArchive",
+# MAGIC   timeout_seconds = 0,
+# MAGIC   arguments = {
+# MAGIC     "ARCHIVE_PATH": "/benchmark/synthetic/parquet",
+# MAGIC     "FILE_FORMAT": "PARQUET",
+# MAGIC     "ROW_COUNT": "1000000",
+# MAGIC     "FILE_COUNT": "10",
+# MAGIC     "COLUMN_COUNT": "20",
+# MAGIC     "CHANGE_RATE": "0.1",
+# MAGIC     "DELETE_RATE": "0.01"
+# MAGIC   }
+# MAGIC )
+# MAGIC ```
+
+# COMMAND ----------
+
+# Parameters
+try:
+    # Archive path e.g. benchmark/synthetic/parquet. Existing files and archive log of the path are removed
+    __ARCHIVE_PATH = dbutils.widgets.get("ARCHIVE_PATH")
+
+    # Optional: Archive log path e.g. benchmark/synthetic/parquet/log
+    __ARCHIVE_LOG_PATH = __ARCHIVE_PATH + "/log"
+    try:
+        __ARCHIVE_LOG_PATH = dbutils.widgets.get("ARCHIVE_LOG_PATH")
+    except:
+        print("Using default archive log path: " + __ARCHIVE_LOG_PATH)
+
+    # Optional: File format. Use "PARQUET", "CSV" or "JSON"
+    __FILE_FORMAT = "PARQUET"
+    try:
+        __FILE_FORMAT = dbutils.widgets.get("FILE_FORMAT")
+    except:
+        print("Using default file format: " + __FILE_FORMAT)
+
+    # Optional: Rows per file
+    __ROW_COUNT = "100000"
+    try:
+        __ROW_COUNT = dbutils.widgets.get("ROW_COUNT")
+    except:
+        print("Using default row count: " + __ROW_COUNT)
+
+    # Optional: Number of files
+    __FILE_COUNT = "10"
+    try:
+        __FILE_COUNT = dbutils.widgets.get("FILE_COUNT")
+    except:
+        print("Using default file count: " + __FILE_COUNT)
+
+    # Optional: Number of value columns in addition to business key column Id
+    __COLUMN_COUNT = "20"
+    try:
+        __COLUMN_COUNT = dbutils.widgets.get("COLUMN_COUNT")
+    except:
+        print("Using default column count: " + __COLUMN_COUNT)
+
+    # Optional: Share of rows that change between consecutive files e.g. 0.1
+    __CHANGE_RATE = "0.1"
+    try:
+        __CHANGE_RATE = dbutils.widgets.get("CHANGE_RATE")
+    except:
+        print("Using default change rate: " + __CHANGE_RATE)
+
+    # Optional: Share of rows deleted between consecutive files e.g. 0.01. The same number of new rows is inserted
+    __DELETE_RATE = "0.01"
+    try:
+        __DELETE_RATE = dbutils.widgets.get("DELETE_RATE")
+    except:
+        print("Using default delete rate: " + __DELETE_RATE)
+
+    # Optional: Schema drift. New value column appears every N files. 0 = no schema drift
+    __SCHEMA_DRIFT_EVERY_N_FILES = "0"
+    try:
+        __SCHEMA_DRIFT_EVERY_N_FILES = dbutils.widgets.get("SCHEMA_DRIFT_EVERY_N_FILES")
+    except:
+        print("Using default schema drift: " + __SCHEMA_DRIFT_EVERY_N_FILES)
+
+except:
+    raise Exception("Required parameter(s) missing")
+
+# COMMAND ----------
+
+# Import
+from pyspark.sql.functions import col, lit, expr, concat, xxhash64, pmod, floor
+from datetime import datetime, timedelta
+import uuid
+import pandas as pd
+
+# Configuration
+__SECRET_SCOPE = "KeyVault"
+__SECRET_NAME_DATA_LAKE_APP_CLIENT_ID = "App-databricks-id"
+__SECRET_NAME_DATA_LAKE_APP_CLIENT_SECRET = "App-databricks-secret"
+__SECRET_NAME_DATA_LAKE_APP_CLIENT_TENANT_ID = "App-databricks-tenant-id"
+__DATA_LAKE_NAME = dbutils.secrets.get(scope = __SECRET_SCOPE, key = "Storage-Name")
+
+__ARCHIVE_PATH = "abfss://archive@" + __DATA_LAKE_NAME + ".dfs.core.windows.net/" + __ARCHIVE_PATH
+__ARCHIVE_LOG_PATH = "abfss://archive@" + __DATA_LAKE_NAME + ".dfs.core.windows.net/" + __ARCHIVE_LOG_PATH
+
+__FILE_FORMAT = __FILE_FORMAT.strip().upper()
+__FILE_EXTENSIONS = { "PARQUET": ".parquet", "CSV": ".csv", "JSON": ".json" }
+if __FILE_FORMAT not in __FILE_EXTENSIONS:
+    raise Exception("Unsupported file format: " + __FILE_FORMAT)
+
+__ROW_COUNT = int(__ROW_COUNT)
+__FILE_COUNT = int(__FILE_COUNT)
+__COLUMN_COUNT = int(__COLUMN_COUNT)
+__CHANGE_RATE = float(__CHANGE_RATE)
+__DELETE_RATE = float(__DELETE_RATE)
+__SCHEMA_DRIFT_EVERY_N_FILES = int(__SCHEMA_DRIFT_EVERY_N_FILES)
+
+# Data lake authentication
+spark.conf.set("fs.azure.account.auth.type." + __DATA_LAKE_NAME + ".dfs.core.windows.net", "OAuth")
+spark.conf.set("fs.azure.account.oauth.provider.type." + __DATA_LAKE_NAME + ".dfs.core.windows.net", "org.apache.hadoop.fs.azurebfs.oauth2.ClientCredsTokenProvider")
+spark.conf.set("fs.azure.account.oauth2.client.id." + __DATA_LAKE_NAME + ".dfs.core.windows.net", dbutils.secrets.get(scope = __SECRET_SCOPE, key = __SECRET_NAME_DATA_LAKE_APP_CLIENT_ID))
+spark.conf.set("fs.azure.account.oauth2.client.secret." + __DATA_LAKE_NAME + ".dfs.core.windows.net", dbutils.secrets.get(scope = __SECRET_SCOPE, key = __SECRET_NAME_DATA_LAKE_APP_CLIENT_SECRET))
+spark.conf.set("fs.azure.account.oauth2.client.endpoint." + __DATA_LAKE_NAME + ".dfs.core.windows.net", "https://login.microsoftonline.com/" + dbutils.secrets.get(scope = __SECRET_SCOPE, key = __SECRET_NAME_DATA_LAKE_APP_CLIENT_TENANT_ID) + "/oauth2/token")
+
+# COMMAND ----------
+
+def getSyntheticFile(fileIndex):
+    # Rows of file are a sliding window of ids. Deleted ids fall out from the bottom and new ids enter from the top
+    deletedRowCount = int(__ROW_COUNT * __DELETE_RATE)
+    dfFile = spark.range(fileIndex * deletedRowCount, fileIndex * deletedRowCount + __ROW_COUNT).withColumnRenamed("id", "Id")
+
+    # Row version increases once per 1 / CHANGE_RATE files with per row offset, so that CHANGE_RATE share of rows change between files
+    changePeriod = int(round(1 / __CHANGE_RATE)) if __CHANGE_RATE > 0 else 0
+    if changePeriod > 0:
+        dfFile = dfFile.withColumn("__Version", floor((lit(fileIndex) + pmod(xxhash64(col("Id")), lit(changePeriod))) / lit(changePeriod)))
+    else:
+        dfFile = dfFile.withColumn("__Version", lit(0))
+
+    columnCount = __COLUMN_COUNT
+    if __SCHEMA_DRIFT_EVERY_N_FILES > 0:
+        columnCount = columnCount + fileIndex // __SCHEMA_DRIFT_EVERY_N_FILES
+
+    # Mixed column types. Values depend only on id, column and row version
+    columns = [col("Id")]
+    for columnIndex in range(columnCount):
+        columnHash = xxhash64(col("Id"), lit(columnIndex), col("__Version"))
+        if columnIndex % 4 == 0:
+            columns.append(concat(lit("Value "), columnHash.cast("string")).alias("Column" + str(columnIndex)))
+        elif columnIndex % 4 == 1:
+            columns.append(columnHash.alias("Column" + str(columnIndex)))
+        elif columnIndex % 4 == 2:
+            columns.append((pmod(columnHash, lit(100000000)) / lit(100)).cast("decimal(18,2)").alias("Column" + str(columnIndex)))
+        else:
+            columns.append(expr("date_add(DATE'2000-01-01', CAST(pmod(xxhash64(Id, " + str(columnIndex) + ", __Version), 10000) AS int))").alias("Column" + str(columnIndex)))
+
+    return dfFile.select(*columns)
+
+# COMMAND ----------
+
+def writeSingleFile(dfFile, filePath):
+    # Archive file is single file like files archived from ingest. Spark output folder is written next to it and removed
+    tempPath = filePath + "_" + str(uuid.uuid4())
+    dfWriter = dfFile.coalesce(1).write.mode("overwrite")
+    if __FILE_FORMAT == "PARQUET":
+        dfWriter.parquet(tempPath)
+    elif __FILE_FORMAT == "CSV":
+        dfWriter.option("header", True).option("encoding", "ISO-8859-1").csv(tempPath)
+    else:
+        dfWriter.json(tempPath)
+
+    partFile = [file for file in dbutils.fs.ls(tempPath) if file.name.startswith("part-")][0]
+    dbutils.fs.mv(partFile.path, filePath)
+    dbutils.fs.rm(tempPath, True)
+    return partFile.size
+
+# COMMAND ----------
+
+print("Remove existing archive: " + __ARCHIVE_PATH)
+dbutils.fs.rm(__ARCHIVE_PATH, True)
+if not __ARCHIVE_LOG_PATH.startswith(__ARCHIVE_PATH + "/"):
+    dbutils.fs.rm(__ARCHIVE_LOG_PATH, True)
+
+# Archive datetimes are in recent past so that loaders with initialized process log pick all files
+archiveLogs = []
+firstArchiveDatetime = datetime.utcnow() - timedelta(hours = 1)
+for fileIndex in range(__FILE_COUNT):
+    archiveDatetime = firstArchiveDatetime + timedelta(seconds = fileIndex)
+    archiveFileName = archiveDatetime.strftime("%H_%M") + "_" + str(uuid.uuid4()) + __FILE_EXTENSIONS[__FILE_FORMAT]
+    archiveFilePath = __ARCHIVE_PATH + "/" + archiveDatetime.strftime("%Y/%m/%d") + "/" + archiveFileName
+
+    fileSize = writeSingleFile(getSyntheticFile(fileIndex), archiveFilePath)
+    print("Generated file " + str(fileIndex + 1) + "/" + str(__FILE_COUNT) + ": " + archiveFilePath)
+
+    archiveLogs.append({
+      'ArchiveDatetimeUTC': archiveDatetime,
+      'ArchiveYearUTC': int(archiveDatetime.year),
+      'ArchiveMonthUTC': int(archiveDatetime.month),
+      'ArchiveDayUTC': int(archiveDatetime.day),
+      'ArchiveyyyyMMddUTC': int(archiveDatetime.strftime("%Y%m%d")),
+      'OriginalStagingFilePath': "synthetic/" + archiveFileName,
+      'OriginalStagingFileName': archiveFileName,
+      'OriginalStagingFileSize': fileSize,
+      'OriginalModificationTime': archiveDatetime,
+      'ArchiveFilePath': archiveFilePath,
+      'ArchiveFileName': archiveFileName
+    })
+
+# COMMAND ----------
+
+if archiveLogs:
+    dfArchiveLogs = spark.createDataFrame(pd.DataFrame(archiveLogs)) \
+                       .selectExpr("CAST(ArchiveDatetimeUTC AS timestamp) AS ArchiveDatetimeUTC", \
+                                   "CAST(ArchiveYearUTC AS int) AS ArchiveYearUTC", \
+                                   "CAST(ArchiveMonthUTC AS int) AS ArchiveMonthUTC", \
+                                   "CAST(ArchiveDayUTC AS int) AS ArchiveDayUTC", \
+                                   "CAST(ArchiveyyyyMMddUTC AS int) AS ArchiveyyyyMMddUTC", \
+                                   "CAST(OriginalStagingFilePath AS string) AS OriginalStagingFilePath", \
+                                   "CAST(OriginalStagingFileName AS string) AS OriginalStagingFileName", \
+                                   "CAST(OriginalStagingFileSize AS long) AS OriginalStagingFileSize", \
+                                   "CAST(OriginalModificationTime AS timestamp) AS OriginalModificationTime", \
+                                   "CAST(ArchiveFilePath AS string) AS ArchiveFilePath", \
+                                   "CAST(ArchiveFileName AS string) AS ArchiveFileName", \
+                                   "CAST(0 AS boolean) AS IsPurged", \
+                                   "CAST(NULL AS timestamp) AS PurgeDatetimeUTC", \
+                                   "CAST(0 AS boolean) AS IsIgnorable", \
+                                   "CAST(NULL AS string) AS Notes")
+    dfArchiveLogs.write.partitionBy("ArchiveyyyyMMddUTC") \
+                       .format("delta") \
+                       .mode("overwrite") \
+                       .save(__ARCHIVE_LOG_PATH)
+    print("Archive log: " + __ARCHIVE_LOG_PATH)
+
+# COMMAND ----------
+
+# Return success
+dbutils.notebook.exit(True)
@@ -0,0 +1,319 @@
+# Databricks notebook source
+# DBTITLE 1,Information
+# MAGIC %md
+# MAGIC Benchmark archive to databricks loaders against synthetic archive data.
+# MAGIC
+# MAGIC Synthetic archive is generated per file format with GenerateSyntheticArchive notebook. Each loader builds its benchmark table from scratch and reports phase timings and Delta operation metrics into a metrics table of the benchmark run (METRICS_PATH of loaders). Summary of each loader is appended to results table with benchmark label, so that optimizations can be compared against stable baseline.
+# MAGIC
+# MAGIC Run benchmarks on dedicated cluster. Loaders are executed one at a time so that timings are not affected by each other.
+# MAGIC Results depend on the cluster that runs them (node type, worker count, runtime version and Spark configuration). Compare only runs of the same cluster configuration.
+# MAGIC
+# MAGIC Required additional libraries:
+# MAGIC - None
+# MAGIC
+# MAGIC Example call:
+# MAGIC ```
+# MAGIC returnFlag = dbutils.notebook.run(
+# MAGIC   path = "/DataLake/__Library/Benchmark/RunLoaderBenchmark",
+# MAGIC   timeout_seconds = 0,
+# MAGIC   arguments = {
+# MAGIC     "BENCHMARK_LABEL": "xxhash64",
+# MAGIC     "BASELINE_LABEL": "baseline",
+# MAGIC     "ROW_COUNT": "1000000",
+# MAGIC     "FILE_COUNT": "10",
+# MAGIC     "LOADER_ARGUMENTS": """{ "HASH_DIFF_ALGORITHM": "XXHASH64" }"""
+# MAGIC   }
+# MAGIC )
+# MAGIC ```
+
+# COMMAND ----------
+
+# Parameters
+try:
+    # Optional: Benchmark label e.g. baseline. Used to compare results of different benchmark runs
+    __BENCHMARK_LABEL = "baseline"
+    try:
+        __BENCHMARK_LABEL = dbutils.widgets.get("BENCHMARK_LABEL")
+    except:
+        print("Using default benchmark label: " + __BENCHMARK_LABEL)
+
+    # Optional: Baseline label e.g. baseline. Results are compared to the latest results of the label
+    __BASELINE_LABEL = ""
+    try:
+        __BASELINE_LABEL = dbutils.widgets.get("BASELINE_LABEL")
+    except:
+        print("No baseline comparison")
+
+    # Optional: Loader notebooks to benchmark as comma separated list
+    __LOADERS = "FromCSVArchiveToDatabricksFact, FromCSVArchiveToDatabricksScd1, FromJsonArchiveToDatabricksFact, FromJsonArchiveToDatabricksScd1, FromParquetArchiveToDatabricksFact, FromParquetArchiveToDatabricksScd1, FromParquetArchiveToDatabricksScd2"
+    try:
+        __LOADERS = dbutils.widgets.get("LOADERS")
+    except:
+        print("Using default loaders: " + __LOADERS)
+
+    # Optional: Additional loader parameters as JSON object e.g. { "HASH_DIFF_ALGORITHM": "XXHASH64" }
+    __LOADER_ARGUMENTS = "{}"
+    try:
+        __LOADER_ARGUMENTS = dbutils.widgets.get("LOADER_ARGUMENTS")
+    except:
+        print("No additional loader arguments")
+
+    # Optional: Benchmark path in archive and datahub containers e.g. benchmark
+    __BENCHMARK_PATH = "benchmark"
+    try:
+        __BENCHMARK_PATH = dbutils.widgets.get("BENCHMARK_PATH")
+    except:
+        print("Using default benchmark path: " + __BENCHMARK_PATH)
+
+    # Optional: Benchmark database e.g. benchmark. Benchmark tables are dropped and created again
+    __TARGET_DATABASE = "benchmark"
+    try:
+        __TARGET_DATABASE = dbutils.widgets.get("TARGET_DATABASE")
+    except:
+        print("Using default target database: " + __TARGET_DATABASE)
+
+    # Optional: Generate synthetic archive. Use "True" or "False"
+    # False = synthetic archive of previous benchmark run is reused
+    __GENERATE = "True"
+    try:
+        __GENERATE = dbutils.widgets.get("GENERATE")
+    except:
+        print("Using default generate: " + __GENERATE)
+
+    # Optional: Synthetic archive. See GenerateSyntheticArchive notebook
+    __ROW_COUNT = "100000"
+    try:
+        __ROW_COUNT = dbutils.widgets.get("ROW_COUNT")
+    except:
+        print("Using default row count: " + __ROW_COUNT)
+
+    __FILE_COUNT = "10"
+    try:
+        __FILE_COUNT = dbutils.widgets.get("FILE_COUNT")
+    except:
+        print("Using default file count: " + __FILE_COUNT)
+
+    __COLUMN_COUNT = "20"
+    try:
+        __COLUMN_COUNT = dbutils.widgets.get("COLUMN_COUNT")
+    except:
+        print("Using default column count: " + __COLUMN_COUNT)
+
+    __CHANGE_RATE = "0.1"
+    try:
+        __CHANGE_RATE = dbutils.widgets.get("CHANGE_RATE")
+    except:
+        print("Using default change rate: " + __CHANGE_RATE)
+
+    __DELETE_RATE = "0.01"
+    try:
+        __DELETE_RATE = dbutils.widgets.get("DELETE_RATE")
+    except:
+        print("Using default delete rate: " + __DELETE_RATE)
+
+    __SCHEMA_DRIFT_EVERY_N_FILES = "0"
+    try:
+        __SCHEMA_DRIFT_EVERY_N_FILES = dbutils.widgets.get("SCHEMA_DRIFT_EVERY_N_FILES")
+    except:
+        print("Using default schema drift: " + __SCHEMA_DRIFT_EVERY_N_FILES)
+
+    # Optional: Folder of library notebooks
+    __NOTEBOOK_FOLDER = "/DataLake/__Library"
+    try:
+        __NOTEBOOK_FOLDER = dbutils.widgets.get("NOTEBOOK_FOLDER")
+    except:
+        print("Using default notebook folder: " + __NOTEBOOK_FOLDER)
+
+except:
+    raise Exception("Required parameter(s) missing")
+
+# COMMAND ----------
+
+# Import
+from pyspark.sql.functions import lit
+from datetime import datetime
+import pandas as pd
+import uuid
+import json
+
+# Configuration
+__SECRET_SCOPE = "KeyVault"
+__SECRET_NAME_DATA_LAKE_APP_CLIENT_ID = "App-databricks-id"
+__SECRET_NAME_DATA_LAKE_APP_CLIENT_SECRET = "App-databricks-secret"
+__SECRET_NAME_DATA_LAKE_APP_CLIENT_TENANT_ID = "App-databricks-tenant-id"
+__DATA_LAKE_NAME = dbutils.secrets.get(scope = __SECRET_SCOPE, key = "Storage-Name")
+
+__BENCHMARK_PATH = __BENCHMARK_PATH.strip("/")
+__BENCHMARK_RUN_ID = str(uuid.uuid4())
+__DATAHUB_URL = "abfss://datahub@" + __DATA_LAKE_NAME + ".dfs.core.windows.net/"
+__METRICS_PATH = __BENCHMARK_PATH + "/metrics/" + __BENCHMARK_RUN_ID
+__RESULTS_PATH = __DATAHUB_URL + __BENCHMARK_PATH + "/results"
+
+__LOADERS = [x.strip() for x in __LOADERS.split(",") if x.strip() != ""]
+__LOADER_ARGUMENTS = json.loads(__LOADER_ARGUMENTS)
+__FILE_FORMATS = { "CSV": "CSV", "Json": "JSON", "Parquet": "PARQUET" }
+
+# Data lake authentication
+spark.conf.set("fs.azure.account.auth.type." + __DATA_LAKE_NAME + ".dfs.core.windows.net", "OAuth")
+spark.conf.set("fs.azure.account.oauth.provider.type." + __DATA_LAKE_NAME + ".dfs.core.windows.net", "org.apache.hadoop.fs.azurebfs.oauth2.ClientCredsTokenProvider")
+spark.conf.set("fs.azure.account.oauth2.client.id." + __DATA_LAKE_NAME + ".dfs.core.windows.net", dbutils.secrets.get(scope = __SECRET_SCOPE, key = __SECRET_NAME_DATA_LAKE_APP_CLIENT_ID))
+spark.conf.set("fs.azure.account.oauth2.client.secret." + __DATA_LAKE_NAME + ".dfs.core.windows.net", dbutils.secrets.get(scope = __SECRET_SCOPE, key = __SECRET_NAME_DATA_LAKE_APP_CLIENT_SECRET))
+spark.conf.set("fs.azure.account.oauth2.client.endpoint." + __DATA_LAKE_NAME + ".dfs.core.windows.net", "https://login.microsoftonline.com/" + dbutils.secrets.get(scope = __SECRET_SCOPE, key = __SECRET_NAME_DATA_LAKE_APP_CLIENT_TENANT_ID) + "/oauth2/token")
+
+# COMMAND ----------
+
+def getFileFormat(loader):
+    for key in __FILE_FORMATS:
+        if loader.startswith("From" + key + "Archive"):
+            return __FILE_FORMATS[key]
+    raise Exception("Unknown file format of loader: " + loader)
+
+# COMMAND ----------
+
+def runLoader(loader):
+    fileFormat = getFileFormat(loader)
+    tableName = loader.lower()
+
+    # JSON fact loader resolves paths from storage URL and expects container as part of path
+    archivePrefix, datahubPrefix = ("archive/", "datahub/") if loader == "FromJsonArchiveToDatabricksFact" else ("", "")
+    arguments = {
+        "ARCHIVE_PATH": archivePrefix + __BENCHMARK_PATH + "/" + fileFormat.lower(),
+        "TARGET_DATABASE": __TARGET_DATABASE,
+        "TARGET_TABLE": tableName,
+        "TARGET_TABLE_BK_COLUMNS": "Id",
+        "TARGET_PATH": datahubPrefix + __BENCHMARK_PATH + "/" + tableName + "/data",
+        "TARGET_LOG_PATH": datahubPrefix + __BENCHMARK_PATH + "/" + tableName + "/log",
+        "EXTRACT_COLUMNS": "*",
+        "METRICS_PATH": datahubPrefix + __METRICS_PATH
+    }
+    arguments.update(__LOADER_ARGUMENTS)
+
+    # Benchmark table is built from scratch
+    spark.sql("DROP TABLE IF EXISTS `" + __TARGET_DATABASE + "`.`" + tableName + "`")
+    dbutils.fs.rm(__DATAHUB_URL + __BENCHMARK_PATH + "/" + tableName, True)
+
+    runLog = {
+        'Loader': loader,
+        'FileFormat': fileFormat,
+        'TargetTable': __TARGET_DATABASE + "." + tableName,
+        'Status': 'Succeeded',
+        'Error': ''
+    }
+
+    print("Benchmark loader: " + loader)
+    try:
+        dbutils.notebook.run(__NOTEBOOK_FOLDER.rstrip("/") + "/FromArchiveToDatabricks/" + loader, 0, arguments)
+    except Exception as e:
+        runLog['Status'] = 'Failed'
+        runLog['Error'] = str(e)[:1000]
+    print("Benchmark loader: " + loader + " " + runLog['Status'])
+
+    return runLog
+
+# COMMAND ----------
+
+spark.sql("CREATE DATABASE IF NOT EXISTS `" + __TARGET_DATABASE + "`")
+
+if __GENERATE.strip().upper() == "TRUE":
+    for fileFormat in sorted(set([getFileFormat(loader) for loader in __LOADERS])):
+        print("Generate synthetic archive: " + fileFormat)
+        dbutils.notebook.run(__NOTEBOOK_FOLDER.rstrip("/") + "/Benchmark/GenerateSyntheticArchive", 0, {
+            "ARCHIVE_PATH": __BENCHMARK_PATH + "/" + fileFormat.lower(),
+            "FILE_FORMAT": fileFormat,
+            "ROW_COUNT": __ROW_COUNT,
+            "FILE_COUNT": __FILE_COUNT,
+            "COLUMN_COUNT": __COLUMN_COUNT,
+            "CHANGE_RATE": __CHANGE_RATE,
+            "DELETE_RATE": __DELETE_RATE,
+            "SCHEMA_DRIFT_EVERY_N_FILES": __SCHEMA_DRIFT_EVERY_N_FILES
+        })
+
+runLogs = [runLoader(loader) for loader in __LOADERS]
+
+# COMMAND ----------
+
+if not [runLog for runLog in runLogs if runLog['Status'] == 'Succeeded']:
+    raise Exception("All loaders failed: " + ", ".join([runLog['Loader'] + ": " + runLog['Error'] for runLog in runLogs]))
+
+# Summary per loader from phase metrics. Target commits of MERGE and BACKFILL phases are MERGE, WRITE (append, replace partitions) or CREATE TABLE AS SELECT (initial load, backfill)
+# WRITE and CREATE TABLE AS SELECT report written rows and files as numOutputRows and numFiles, and files removed by overwrite as numRemovedFiles
+# Replace partitions rewrites whole partitions, so its written rows are counted as inserted
+dfSummary = spark.sql(" \
+  WITH     Metrics AS ( \
+             SELECT *, \
+                    Phase IN ('MERGE', 'BACKFILL') AND Operation = 'MERGE' AS IsMerge, \
+                    Phase IN ('MERGE', 'BACKFILL') AND (Operation = 'WRITE' OR Operation LIKE '%TABLE AS SELECT') AS IsWrite \
+             FROM   delta.`" + __DATAHUB_URL + __METRICS_PATH + "` \
+           ) \
+  SELECT   TargetTable, \
+           COUNT(DISTINCT CASE WHEN Phase = 'READ' THEN ArchiveFilePath END) AS Files, \
+           SUM(CASE WHEN Phase = 'READ' THEN NumSourceRows END) AS SourceRows, \
+           SUM(CASE WHEN Phase = 'RUN' THEN DurationSeconds END) AS RunSeconds, \
+           SUM(CASE WHEN Phase = 'READ' THEN DurationSeconds END) AS ReadSeconds, \
+           SUM(CASE WHEN Phase = 'MERGE' THEN DurationSeconds END) AS MergeSeconds, \
+           SUM(CASE WHEN Phase = 'OPTIMIZE' THEN DurationSeconds END) AS OptimizeSeconds, \
+           SUM(CASE WHEN IsMerge THEN NumTargetRowsInserted WHEN IsWrite THEN NumOutputRows END) AS RowsInserted, \
+           SUM(CASE WHEN IsMerge THEN NumTargetRowsUpdated END) AS RowsUpdated, \
+           SUM(CASE WHEN IsMerge THEN NumTargetRowsDeleted END) AS RowsDeleted, \
+           SUM(CASE WHEN IsMerge THEN NumTargetFilesAdded WHEN IsWrite THEN CAST(OperationMetrics['numFiles'] AS long) END) AS FilesAdded, \
+           SUM(CASE WHEN IsMerge THEN NumTargetFilesRemoved WHEN IsWrite THEN CAST(OperationMetrics['numRemovedFiles'] AS long) END) AS FilesRewritten \
+  FROM     Metrics \
+  GROUP BY TargetTable \
+")
+
+dfResults = spark.createDataFrame(pd.DataFrame(runLogs)) \
+                 .join(dfSummary, "TargetTable", "left") \
+                 .withColumn("BenchmarkRunId", lit(__BENCHMARK_RUN_ID)) \
+                 .withColumn("BenchmarkLabel", lit(__BENCHMARK_LABEL)) \
+                 .withColumn("BenchmarkDatetimeUTC", lit(datetime.utcnow())) \
+                 .withColumn("RowCount", lit(int(__ROW_COUNT))) \
+                 .withColumn("FileCount", lit(int(__FILE_COUNT))) \
+                 .withColumn("ColumnCount", lit(int(__COLUMN_COUNT))) \
+                 .withColumn("ChangeRate", lit(float(__CHANGE_RATE))) \
+                 .withColumn("DeleteRate", lit(float(__DELETE_RATE))) \
+                 .withColumn("SchemaDriftEveryNFiles", lit(int(__SCHEMA_DRIFT_EVERY_N_FILES))) \
+                 .withColumn("LoaderArguments", lit(json.dumps(__LOADER_ARGUMENTS))) \
+                 .selectExpr("BenchmarkRunId", "BenchmarkLabel", "BenchmarkDatetimeUTC", "Loader", "FileFormat", "Status", "Error", \
+                             "RowCount", "FileCount", "ColumnCount", "ChangeRate", "DeleteRate", "SchemaDriftEveryNFiles", "LoaderArguments", \
+                             "Files", "SourceRows", "RunSeconds", "ROUND(SourceRows / RunSeconds, 1) AS RowsPerSecond", \
+                             "ReadSeconds", "MergeSeconds", "OptimizeSeconds", \
+                             "RowsInserted", "RowsUpdated", "RowsDeleted", "FilesAdded", "FilesRewritten")
+
+dfResults.write.format("delta") \
+         .mode("append") \
+         .option("mergeSchema", "true") \
+         .save(__RESULTS_PATH)
+print("Benchmark results: " + __RESULTS_PATH)
+dfResults.display()
+
+# COMMAND ----------
+
+if __BASELINE_LABEL != "":
+    # Ratio below 1 means that benchmark run is faster than the latest baseline run
+    spark.sql(" \
+      WITH baseline AS ( \
+        SELECT *, ROW_NUMBER() OVER (PARTITION BY Loader ORDER BY BenchmarkDatetimeUTC DESC) AS RowNumber \
+        FROM   delta.`" + __RESULTS_PATH + "` \
+        WHERE  BenchmarkLabel = '" + __BASELINE_LABEL.replace("'", "''") + "' AND Status = 'Succeeded' AND BenchmarkRunId != '" + __BENCHMARK_RUN_ID + "' \
+      ) \
+      SELECT r.Loader, \
+             b.RunSeconds AS BaselineRunSeconds, r.RunSeconds, ROUND(r.RunSeconds / b.RunSeconds, 2) AS RunSecondsRatio, \
+             b.MergeSeconds AS BaselineMergeSeconds, r.MergeSeconds, ROUND(r.MergeSeconds / b.MergeSeconds, 2) AS MergeSecondsRatio, \
+             b.RowsPerSecond AS BaselineRowsPerSecond, r.RowsPerSecond, \
+             b.FilesRewritten AS BaselineFilesRewritten, r.FilesRewritten \
+      FROM   delta.`" + __RESULTS_PATH + "` r \
+             INNER JOIN baseline b ON b.Loader = r.Loader AND b.RowNumber = 1 \
+      WHERE  r.BenchmarkRunId = '" + __BENCHMARK_RUN_ID + "' \
+      ORDER BY r.Loader \
+    ").display()
+
+# COMMAND ----------
+
+failedLoaders = [runLog['Loader'] for runLog in runLogs if runLog['Status'] != 'Succeeded']
+if failedLoaders:
+    raise Exception("Loader(s) failed: " + ", ".join(failedLoaders))
+
+# COMMAND ----------
+
+# Return success
+dbutils.notebook.exit(True)
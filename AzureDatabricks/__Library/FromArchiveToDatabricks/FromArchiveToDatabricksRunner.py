@@ -0,0 +1,146 @@
+# Databricks notebook source
+# DBTITLE 1,Information
+# MAGIC %md
+# MAGIC Run several archive to databricks loaders in parallel on the same cluster.
+# MAGIC
+# MAGIC Loaders are executed from driver threads with bounded concurrency. Each loader runs in its own fair scheduler pool so that small merges are not queued behind large ones.
+# MAGIC
+# MAGIC Required additional libraries:
+# MAGIC - None
+# MAGIC
+# MAGIC Example call:
+# MAGIC ```
+# MAGIC returnFlag = dbutils.notebook.run(
+# MAGIC   path = "/DataLake/__Library/FromArchiveToDatabricks/FromArchiveToDatabricksRunner",
+# MAGIC   timeout_seconds = 0,
+# MAGIC   arguments = {
+# MAGIC     "LOADERS": """[
+# MAGIC       {
+# MAGIC         "NOTEBOOK": "FromParquetArchiveToDatabricksScd1",
+# MAGIC         "ARGUMENTS": {
+# MAGIC           "ARCHIVE_PATH": "/archive/adventureworkslt/customer",
+# MAGIC           "TARGET_DATABASE": "adventureworkslt",
+# MAGIC           "TARGET_TABLE": "customer",
+# MAGIC           "TARGET_TABLE_BK_COLUMNS": "CustomerID",
+# MAGIC           "TARGET_PATH": "/analytics/datahub/adventureworkslt/customer/data",
+# MAGIC           "TARGET_LOG_PATH": "/analytics/datahub/adventureworkslt/customer/log"
+# MAGIC         }
+# MAGIC       },
+# MAGIC       {
+# MAGIC         "NOTEBOOK": "FromParquetArchiveToDatabricksFact",
+# MAGIC         "ARGUMENTS": {
+# MAGIC           "ARCHIVE_PATH": "/archive/adventureworkslt/salesorderdetail",
+# MAGIC           "TARGET_DATABASE": "adventureworkslt",
+# MAGIC           "TARGET_TABLE": "salesorderdetail",
+# MAGIC           "TARGET_TABLE_BK_COLUMNS": "SalesOrderID, SalesOrderDetailID",
+# MAGIC           "TARGET_PATH": "/analytics/datahub/adventureworkslt/salesorderdetail/data",
+# MAGIC           "TARGET_LOG_PATH": "/analytics/datahub/adventureworkslt/salesorderdetail/log"
+# MAGIC         }
+# MAGIC       }
+# MAGIC     ]""",
+# MAGIC     "MAX_PARALLELISM": "4"
+# MAGIC   }
+# MAGIC )
+# MAGIC ```
+
+# COMMAND ----------
+
+# Parameters
+try:
+    # Loader configurations as JSON array. Each configuration has
+    # - NOTEBOOK: Loader notebook name e.g. FromParquetArchiveToDatabricksScd1 or full notebook path
+    # - ARGUMENTS: Loader parameters. Numbers and booleans are passed to loader as text
+    # - Optional SCHEDULER_POOL: Fair scheduler pool of loader. Default is loader_<TARGET_DATABASE>_<TARGET_TABLE>
+    __LOADERS = dbutils.widgets.get("LOADERS")
+
+    # Optional: Maximum number of loaders executed at the same time
+    __MAX_PARALLELISM = "4"
+    try:
+        __MAX_PARALLELISM = dbutils.widgets.get("MAX_PARALLELISM")
+    except:
+        print("Using default maximum parallelism: " + __MAX_PARALLELISM)
+
+    # Optional: Timeout of single loader in seconds. 0 = no timeout
+    __TIMEOUT_SECONDS = "0"
+    try:
+        __TIMEOUT_SECONDS = dbutils.widgets.get("TIMEOUT_SECONDS")
+    except:
+        print("Using default timeout seconds: " + __TIMEOUT_SECONDS)
+
+    # Optional: Folder of loader notebooks used with notebook names
+    __NOTEBOOK_FOLDER = "/DataLake/__Library/FromArchiveToDatabricks"
+    try:
+        __NOTEBOOK_FOLDER = dbutils.widgets.get("NOTEBOOK_FOLDER")
+    except:
+        print("Using default notebook folder: " + __NOTEBOOK_FOLDER)
+
+except:
+    raise Exception("Required parameter(s) missing")
+
+# COMMAND ----------
+
+# Import
+from datetime import datetime
+from joblib import Parallel, delayed, parallel_backend
+import json
+import pandas as pd
+import time
+
+# COMMAND ----------
+
+def runLoader(loader):
+    # Loader runs as child notebook within the same Spark application. Failure of one loader does not stop others
+    notebookPath = loader["NOTEBOOK"] if loader["NOTEBOOK"].startswith("/") else __NOTEBOOK_FOLDER.rstrip("/") + "/" + loader["NOTEBOOK"]
+    # Notebook arguments are strings. JSON numbers and booleans are passed as text e.g. 4 = "4", true = "True"
+    arguments = { name: str(value) for name, value in loader["ARGUMENTS"].items() }
+    arguments["SCHEDULER_POOL"] = str(loader.get("SCHEDULER_POOL", "loader_" + arguments.get("TARGET_DATABASE", "") + "_" + arguments.get("TARGET_TABLE", "")))
+
+    runLog = {
+        'Notebook': notebookPath,
+        'TargetTable': arguments.get("TARGET_DATABASE", "") + "." + arguments.get("TARGET_TABLE", ""),
+        'SchedulerPool': arguments["SCHEDULER_POOL"],
+        'StartDatetimeUTC': datetime.utcnow(),
+        'DurationSeconds': 0.0,
+        'Status': 'Succeeded',
+        'Error': ''
+    }
+
+    print("Start loader: " + runLog['TargetTable'] + " (" + notebookPath + ")")
+    startTime = time.time()
+    try:
+        dbutils.notebook.run(notebookPath, int(__TIMEOUT_SECONDS), arguments)
+    except Exception as e:
+        runLog['Status'] = 'Failed'
+        runLog['Error'] = str(e)[:1000]
+    runLog['DurationSeconds'] = round(time.time() - startTime, 1)
+    print("End loader: " + runLog['TargetTable'] + " " + runLog['Status'] + " in " + str(runLog['DurationSeconds']) + " s")
+
+    return runLog
+
+# COMMAND ----------
+
+loaders = json.loads(__LOADERS)
+for loader in loaders:
+    if "NOTEBOOK" not in loader or "ARGUMENTS" not in loader:
+        raise Exception("Loader configuration requires NOTEBOOK and ARGUMENTS: " + json.dumps(loader))
+    invalidArguments = [name for name, value in loader["ARGUMENTS"].items() if not isinstance(value, (str, int, float, bool))]
+    if invalidArguments:
+        raise Exception("Loader argument values must be strings, numbers or booleans: " + ", ".join(invalidArguments))
+
+print("Run " + str(len(loaders)) + " loaders with maximum parallelism " + __MAX_PARALLELISM)
+with parallel_backend('threading', n_jobs=int(__MAX_PARALLELISM)):
+    runLogs = Parallel()(delayed(runLoader)(loader) for loader in loaders)
+
+# COMMAND ----------
+
+if runLogs:
+    display(spark.createDataFrame(pd.DataFrame(runLogs)))
+
+failedLoaders = [runLog['TargetTable'] for runLog in runLogs if runLog['Status'] != 'Succeeded']
+if failedLoaders:
+    raise Exception("Loader(s) failed: " + ", ".join(failedLoaders))
+
+# COMMAND ----------
+
+# Return success
+dbutils.notebook.exit(True)
@@ -66,6 +66,15 @@ try:
     except:
         print('No partition by columns')  
     
+    # Include previous. Use "True" or "False"
+    # True = ArchiveDatetimeUTC >= lastArchiveDatetimeUTC
+    # False = ArchiveDatetimeUTC > lastArchiveDatetimeUTC
+    __INCLUDE_PREVIOUS = "False"
+    try:
+        __INCLUDE_PREVIOUS = dbutils.widgets.get("INCLUDE_PREVIOUS")
+    except:
+        print("Using default include previous: " + __INCLUDE_PREVIOUS)
+    
     __COMPLEX_AS_STRING = "False"
     try:
         __COMPLEX_AS_STRING = dbutils.widgets.get("COMPLEX_AS_STRING")
@@ -79,6 +88,183 @@ try:
     except:
         print('No update filter') 
     
+    # Hash diff algorithm. Use "SHA256", "SHA256_BINARY" or "XXHASH64"
+    # SHA256 = SHA-256 hex string over columns concatenated as strings (compatible with existing tables)
+    # XXHASH64 = 64-bit xxHash over typed column values with explicit null markers, stored as long
+    # SHA256_BINARY = the same SHA-256 as SHA256 stored as 32 bytes instead of 64 character hex string. Existing SHA256 tables are converted with System/MigrateHashDiff
+    __HASH_DIFF_ALGORITHM = "SHA256"
+    try:
+        __HASH_DIFF_ALGORITHM = dbutils.widgets.get("HASH_DIFF_ALGORITHM")
+    except:
+        print("Using default hash diff algorithm: " + __HASH_DIFF_ALGORITHM)
+    
+    # Flatten nested struct columns into prefixed columns e.g. True. Field City in struct Address becomes Address_City
+    __FLATTEN_STRUCTS = "False"
+    try:
+        __FLATTEN_STRUCTS = dbutils.widgets.get("FLATTEN_STRUCTS")
+    except:
+        print('No struct flattening')
+    
+    # Optional: Maximum struct depth to flatten e.g. 2. Structs below the depth are kept as struct columns
+    __FLATTEN_MAX_DEPTH = "10"
+    try:
+        __FLATTEN_MAX_DEPTH = dbutils.widgets.get("FLATTEN_MAX_DEPTH")
+    except:
+        print("Using default flatten max depth: " + __FLATTEN_MAX_DEPTH)
+    
+    # Optional: Separator between parent and child names of flattened columns
+    __FLATTEN_SEPARATOR = "_"
+    try:
+        __FLATTEN_SEPARATOR = dbutils.widgets.get("FLATTEN_SEPARATOR")
+    except:
+        print("Using default flatten separator: " + __FLATTEN_SEPARATOR)
+    
+    # Array columns to explode into child tables e.g. OrderLines, Address_Phones
+    # Child table <TARGET_TABLE>_<column> in path <TARGET_PATH>_<column> contains parent business keys, __Index and element columns
+    __EXPLODE_ARRAYS = ""
+    try:
+        __EXPLODE_ARRAYS = dbutils.widgets.get("EXPLODE_ARRAYS")
+    except:
+        print('No arrays to explode')
+    
+    # JSON schema cache. Use "False", "True" or "Refresh"
+    # True = schema is inferred once and stored next to target log. Later files are read with stored schema without inference pass
+    # Refresh = schema is inferred again from first file of the run and stored
+    __JSON_SCHEMA_CACHE = "False"
+    try:
+        __JSON_SCHEMA_CACHE = dbutils.widgets.get("JSON_SCHEMA_CACHE")
+    except:
+        print('No JSON schema cache')
+    
+    # Load mode. Use "MERGE", "APPEND_ONLY" or "REPLACE_PARTITIONS"
+    # MERGE = insert, update and delete detection by business keys
+    # APPEND_ONLY = blind append of file rows without join to target. For event/log sources where business keys never repeat
+    # REPLACE_PARTITIONS = file is complete snapshot of the partitions it contains. Those partitions are overwritten, rows missing from file are marked deleted
+    __LOAD_MODE = "MERGE"
+    try:
+        __LOAD_MODE = dbutils.widgets.get("LOAD_MODE")
+    except:
+        print("Using default load mode: " + __LOAD_MODE)
+    
+    # Optional: Append archive file only once even when it is processed again e.g. True. Used with APPEND_ONLY load mode
+    __APPEND_IDEMPOTENT = "True"
+    try:
+        __APPEND_IDEMPOTENT = dbutils.widgets.get("APPEND_IDEMPOTENT")
+    except:
+        print("Using default append idempotency: " + __APPEND_IDEMPOTENT)
+    
+    # Backfill. Use "True" to load all archive files since BACKFILL_START_DATETIME into new target table in single load
+    # Final state (SCD1/fact) or version history (SCD2) is calculated over all files at once instead of file by file
+    __BACKFILL = "False"
+    try:
+        __BACKFILL = dbutils.widgets.get("BACKFILL")
+    except:
+        print('No backfill')
+    
+    # Optional: Backfill start datetime e.g. 2015-01-01. Archive files archived after the datetime are loaded
+    __BACKFILL_START_DATETIME = "1900-01-01"
+    try:
+        __BACKFILL_START_DATETIME = dbutils.widgets.get("BACKFILL_START_DATETIME")
+    except:
+        print("Using default backfill start datetime: " + __BACKFILL_START_DATETIME)
+    
+    # Target clustering at optimize. Use "ZORDER", "LIQUID" or "NONE"
+    # ZORDER = OPTIMIZE ZORDER BY business key columns. Partition columns are excluded
+    # LIQUID = liquid clustering by business key columns. Databricks Runtime 13.3 LTS or later, not supported with partitioned table
+    __TARGET_CLUSTERING = "ZORDER"
+    try:
+        __TARGET_CLUSTERING = dbutils.widgets.get("TARGET_CLUSTERING")
+    except:
+        print("Using default target clustering: " + __TARGET_CLUSTERING)
+    
+    # Maintenance mode of target and log tables. Use "AUTO", "ALWAYS" or "NONE"
+    # AUTO = OPTIMIZE only when small files have accumulated, ALWAYS = OPTIMIZE on every run
+    # NONE = no OPTIMIZE, tables are maintained by System/DeltaMaintenance notebook
+    __MAINTENANCE_MODE = "AUTO"
+    try:
+        __MAINTENANCE_MODE = dbutils.widgets.get("MAINTENANCE_MODE")
+    except:
+        print("Using default maintenance mode: " + __MAINTENANCE_MODE)
+    
+    # Optional: Compact lineage. Use "True" or "False"
+    # True = rows store 64-bit __ArchiveFileId instead of __ArchiveFilePath and __OriginalStagingFileName strings
+    # Original columns are exposed by view <TARGET_TABLE>_lineage. Decided at initial table creation
+    __COMPACT_LINEAGE = "False"
+    try:
+        __COMPACT_LINEAGE = dbutils.widgets.get("COMPACT_LINEAGE")
+    except:
+        print("Using default compact lineage: " + __COMPACT_LINEAGE)
+    
+    # Optional: Spark fair scheduler pool of the load e.g. loader_adventureworkslt_customer
+    # Set by FromArchiveToDatabricksRunner so that loaders running in parallel share the cluster fairly
+    __SCHEDULER_POOL = ""
+    try:
+        __SCHEDULER_POOL = dbutils.widgets.get("SCHEDULER_POOL")
+    except:
+        print("Using default scheduler pool")
+    
+    # Optional: Skip unchanged files. Use "True" or "False"
+    # True = file is not merged when its rows are equal to the last loaded file. Only process log row is recorded
+    __SKIP_UNCHANGED = "False"
+    try:
+        __SKIP_UNCHANGED = dbutils.widgets.get("SKIP_UNCHANGED")
+    except:
+        print("Using default skip unchanged: " + __SKIP_UNCHANGED)
+    
+    # Optional: Metrics delta path e.g. /analytics/datahub/__metrics/loader
+    # Phase timings and Delta operation metrics of each file and run are appended to this table. Empty = no metrics
+    __METRICS_PATH = ""
+    try:
+        __METRICS_PATH = dbutils.widgets.get("METRICS_PATH")
+    except:
+        print("No metrics")
+    
+    # Optional: Process log commit interval in files e.g. 1
+    # Process log (watermark) is committed after every N merged files so that failed run resumes from the last committed file. 0 = commit at the end of run
+    __PROCESS_LOG_COMMIT_INTERVAL = "1"
+    try:
+        __PROCESS_LOG_COMMIT_INTERVAL = dbutils.widgets.get("PROCESS_LOG_COMMIT_INTERVAL")
+    except:
+        print("Using default process log commit interval: " + __PROCESS_LOG_COMMIT_INTERVAL)
+    
+    # Optional: Deduplicate source rows by business key before merge. Use "True" or "False"
+    # True = one row per business key is kept from each archive file, so that merge does not fail on multiple matching source rows
+    __DEDUPLICATE = "False"
+    try:
+        __DEDUPLICATE = dbutils.widgets.get("DEDUPLICATE")
+    except:
+        print("Using default deduplicate: " + __DEDUPLICATE)
+    
+    # Optional: Order of duplicate rows e.g. ModifiedDate DESC. The first row is kept. Empty = the last occurrence in file is kept
+    __DEDUPLICATE_ORDER_BY = ""
+    try:
+        __DEDUPLICATE_ORDER_BY = dbutils.widgets.get("DEDUPLICATE_ORDER_BY")
+    except:
+        print("No deduplicate order by")
+    
+    # Optional: Transformation SQL query over archive file rows, referenced as {source} e.g. SELECT *, TRIM(Name) AS NameTrimmed FROM {source} WHERE Status <> 'X'
+    # Transformation runs before deduplication and hash diff in the same plan as read and merge
+    __TRANSFORM_SQL = ""
+    try:
+        __TRANSFORM_SQL = dbutils.widgets.get("TRANSFORM_SQL")
+    except:
+        print("No transform SQL")
+    
+    # Optional: Vectorized transformation function used with mapInPandas as module:function e.g. transformations.customer:cleanse
+    # Function receives iterator of pandas data frames and yields pandas data frames. Module is imported from workspace files or repository
+    __TRANSFORM_FUNCTION = ""
+    try:
+        __TRANSFORM_FUNCTION = dbutils.widgets.get("TRANSFORM_FUNCTION")
+    except:
+        print("No transform function")
+    
+    # Optional: Output schema of transform function as DDL e.g. CustomerID INT, Name STRING. Empty = input schema
+    __TRANSFORM_SCHEMA = ""
+    try:
+        __TRANSFORM_SCHEMA = dbutils.widgets.get("TRANSFORM_SCHEMA")
+    except:
+        print("No transform schema")
+    
 except:
     raise Exception("Required parameter(s) missing")
 
@@ -87,12 +273,20 @@ except:
 # Import
 import sys
 from delta.tables import *
-from pyspark.sql.functions import lit, col, sha2, concat_ws, to_json, struct
-from pyspark.sql.types import StringType
+from pyspark import StorageLevel
+from pyspark.sql.functions import lit, col, sha2, unhex, concat_ws, to_json, struct, xxhash64, posexplode, size, when, expr
+from pyspark.sql.functions import row_number, lag, lead, last, broadcast, regexp_replace, input_file_name
+from pyspark.sql.window import Window
+from pyspark.sql.types import StringType, StructType
 from pyspark.sql.utils import AnalysisException
-from datetime import datetime
+from datetime import datetime, date, timedelta
+from decimal import Decimal
+import hashlib
+import importlib
 import pandas as pd
 import uuid
+import time
+import json
 
 # Enable automatic schema evolution and optimization
 spark.sql("SET spark.databricks.delta.schema.autoMerge.enabled = true") 
@@ -111,16 +305,33 @@ __DATA_LAKE_URL = dbutils.secrets.get(scope = __SECRET_SCOPE, key = "Storage-URL
 __ARCHIVE_PATH = __DATA_LAKE_URL + "/" + __ARCHIVE_PATH
 __ARCHIVE_LOG_PATH = __DATA_LAKE_URL + "/" + __ARCHIVE_LOG_PATH
 __TARGET_PATH = __DATA_LAKE_URL + "/" + __TARGET_PATH
+__JSON_SCHEMA_CACHE_PATH = __DATA_LAKE_URL + "/" + __TARGET_LOG_PATH + "/jsonSchema/schema.json"
 __TARGET_LOG_PATH = __DATA_LAKE_URL + "/" + __TARGET_LOG_PATH + "/processDatetime/"
 
 __TARGET_TABLE_FULLY_QUALIEFIED_NAME = "`" + __TARGET_DATABASE + "`.`" + __TARGET_TABLE + "`"
 
+# Run metrics. Phase durations are measured from run start
+if __METRICS_PATH != "":
+    __METRICS_PATH = __DATA_LAKE_URL + "/" + __METRICS_PATH
+__RUN_ID = str(uuid.uuid4())
+runStartTime = time.perf_counter()
+metrics = []
+metricsVersions = {}
+
 # Delta optimization
 # https://docs.databricks.com/delta/optimizations/auto-optimize.html#how-auto-optimize-works
 spark.conf.set("spark.databricks.delta.optimizeWrite.enabled", True)
-spark.conf.set("spark.databricks.delta.autoCompact.enabled", False)         # Not to be enabled because of regular OPTIMIZE calls on table
+spark.conf.set("spark.databricks.delta.autoCompact.enabled", False)         # Not to be enabled because of OPTIMIZE calls on table
 spark.conf.set("spark.databricks.delta.autoCompact.maxFileSize", 134217728) # 128 MB
 
+# Maintenance thresholds of MAINTENANCE_MODE = AUTO
+__MAINTENANCE_MIN_FILES = 50                    # Optimize when table has at least this many files ...
+__MAINTENANCE_SMALL_FILE_SIZE = 33554432        # ... and average file size is below 32 MB
+
+# Fair scheduler pool. Local property applies to Spark jobs started from this notebook
+if __SCHEDULER_POOL != "":
+    spark.sparkContext.setLocalProperty("spark.scheduler.pool", __SCHEDULER_POOL)
+
 # Data lake authentication
 spark.conf.set("fs.azure.account.auth.type." + __DATA_LAKE_NAME + ".dfs.core.windows.net", "OAuth")
 spark.conf.set("fs.azure.account.oauth.provider.type." + __DATA_LAKE_NAME + ".dfs.core.windows.net", "org.apache.hadoop.fs.azurebfs.oauth2.ClientCredsTokenProvider")
@@ -147,6 +358,12 @@ except Exception as ex:
     print(ex)
     raise
 
+__BACKFILL = __BACKFILL.strip().upper()
+if __BACKFILL == "TRUE":
+    # Backfill selects archive files from backfill start regardless of process log
+    lastArchiveDatetimeUTC = __BACKFILL_START_DATETIME
+    print("Backfill from time: " + str(lastArchiveDatetimeUTC))
+
 # COMMAND ----------
 
 def getMatchCondition(columns, note, sourceAlias = "s", targetAlias = "t", nullSafe = True):
@@ -196,22 +413,565 @@ def getPartitionCondition(dfSource, columns, note, targetAlias = "t", nullSafe =
 
 # COMMAND ----------
 
-def getColumnsWithAlias(columns, alias):
-    includeConditionJoin = False
-    conditionJoin = ", "
-    condition = ""
-  
-    for columnIndex, columnName in enumerate(columns):
-        if includeConditionJoin == True:
-            condition += conditionJoin
-      
-        condition += alias + "." + columnName
-        includeConditionJoin = True
+def getSqlLiteral(value):
+    if value is None:
+        return "NULL"
+    if isinstance(value, bool):
+        return "TRUE" if value == True else "FALSE"
+    if isinstance(value, (int, Decimal)):
+        return str(value)
+    if isinstance(value, float):
+        return "CAST('" + repr(value) + "' AS DOUBLE)"
+    if isinstance(value, datetime):
+        return "CAST('" + str(value) + "' AS timestamp)"
+    if isinstance(value, date):
+        return "CAST('" + str(value) + "' AS date)"
+    return "'" + str(value).replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+# COMMAND ----------
+
+def getValuesCondition(dfSource, columns, note, targetAlias = "t"):
+    # Distinct value combinations of the columns in source as predicate on target. Without alias for replaceWhere
+    columnPrefix = "" if targetAlias is None else targetAlias + "."
+    valueConditions = []
+    for row in dfSource.select(*columns).distinct().collect():
+        valueConditions.append("(" + " AND ".join(columnPrefix + columnName + " <=> " + getSqlLiteral(row[columnIndex]) for columnIndex, columnName in enumerate(columns)) + ")")
     
+    if not valueConditions:
+        return "1 = 0"
+    
+    return "(" + " OR ".join(valueConditions) + ")"
+
+# COMMAND ----------
+
+def getDeleteCondition(dfSource, deleteFilterColumns, targetAlias = "t"):
+    # Record is considered deleted if it exists in target table but does not exists in source (archive record)
+    condition = targetAlias + ".`__DeletedDatetimeUTC` IS NULL"
+    
+    if deleteFilterColumns is not None:
+        # Delete is done only when values on delete filter columns exists both on source and target
+        condition += " AND " + getValuesCondition(dfSource, deleteFilterColumns, "Delete filter columns", targetAlias)
+    
+    print("Delete condition: " + condition)
     return condition
 
 # COMMAND ----------
 
+def getHashDiffColumn(columns, algorithm):
+    if algorithm == "XXHASH64":
+        # Typed hash over columns in name order. Null marker per column keeps NULL, empty string and shifted values apart
+        hashColumns = []
+        for columnName in sorted(columns, key = lambda x: x.lower()):
+            hashColumns.append(col("`" + columnName + "`"))
+            hashColumns.append(col("`" + columnName + "`").isNull())
+        return xxhash64(*hashColumns)
+    
+    hashDiff = sha2(to_json(struct(*[col("`" + columnName + "`") for columnName in columns])), 256)
+    if algorithm == "SHA256_BINARY":
+        # Same digest as SHA256, so existing hex values convert with unhex
+        return unhex(hashDiff)
+    
+    return hashDiff
+
+# COMMAND ----------
+
+def getColumnAssignments(columns, sourceAlias = "s"):
+    assignments = {}
+    for columnName in columns:
+        assignments["`" + columnName + "`"] = col(sourceAlias + ".`" + columnName + "`")
+    
+    return assignments
+
+# COMMAND ----------
+
+def evolveTargetSchema(dfSource, targetPath):
+    targetColumns = [c.lower() for c in DeltaTable.forPath(spark, targetPath).toDF().columns]
+    newFields = [f for f in dfSource.schema.fields if f.name.lower() not in targetColumns]
+    
+    if newFields:
+        print("Add new columns: " + ", ".join(f.name for f in newFields))
+        spark.sql("ALTER TABLE delta.`" + targetPath + "` ADD COLUMNS (" + ", ".join("`" + f.name + "` " + f.dataType.simpleString() for f in newFields) + ")")
+
+# COMMAND ----------
+
+def getFlattenedFields(schema, maxDepth, separator, parentPath = [], depth = 0):
+    # Struct fields as (path, flattened name). Arrays and structs below max depth are kept as they are
+    fields = []
+    for field in schema.fields:
+        fieldPath = parentPath + [field.name]
+        if isinstance(field.dataType, StructType) and depth < maxDepth:
+            fields += getFlattenedFields(field.dataType, maxDepth, separator, fieldPath, depth + 1)
+        else:
+            fields.append((fieldPath, separator.join(fieldPath)))
+    
+    return fields
+
+# COMMAND ----------
+
+flattenedFieldsCache = {}
+def getFlattenedColumns(schema, maxDepth, separator, parentColumn = None):
+    # Flatten plan is resolved once per distinct schema
+    cacheKey = (schema.json(), parentColumn)
+    if cacheKey not in flattenedFieldsCache:
+        fields = getFlattenedFields(schema, maxDepth, separator)
+        flattenedNames = [name.lower() for path, name in fields]
+        duplicateNames = sorted(set(name for name in flattenedNames if flattenedNames.count(name) > 1))
+        if duplicateNames:
+            raise Exception("Flattened column name(s) not unique: " + ", ".join(duplicateNames))
+        flattenedFieldsCache[cacheKey] = fields
+    
+    parentPath = [] if parentColumn is None else [parentColumn]
+    return [col(".".join("`" + p + "`" for p in parentPath + path)).alias(name) for path, name in flattenedFieldsCache[cacheKey]]
+
+# COMMAND ----------
+
+def getChildSource(dfDocument, arrayColumn, parentKeyColumns, archiveLog, datetimeUtcNow):
+    # One row per array element with parent business keys and element position
+    dfChild = dfDocument.select(*parentKeyColumns, posexplode(col("`" + arrayColumn + "`")).alias("__Index", "__Element"))
+    
+    elementType = dfChild.schema["__Element"].dataType
+    if isinstance(elementType, StructType):
+        # Struct element fields become columns of child table
+        elementColumns = getFlattenedColumns(elementType, __FLATTEN_MAX_DEPTH if __FLATTEN_STRUCTS == "TRUE" else 0, __FLATTEN_SEPARATOR, "__Element")
+    else:
+        elementColumns = [col("__Element").alias(arrayColumn)]
+    
+    dfChild = dfChild.select(*parentKeyColumns, col("__Index"), *elementColumns)
+    
+    parentKeyNames = [c.strip('`').lower() for c in parentKeyColumns]
+    conflictingNames = [c for c in dfChild.columns[len(parentKeyColumns) + 1:] if c.lower() in parentKeyNames]
+    if conflictingNames:
+        raise Exception("Array '" + arrayColumn + "' element column(s) conflict with business key columns: " + ", ".join(conflictingNames))
+    
+    return dfChild.withColumn("__HashDiff", getHashDiffColumn(dfChild.columns, __HASH_DIFF_ALGORITHM)) \
+                  .withColumn('__ModifiedDatetimeUTC', lit(datetimeUtcNow)) \
+                  .withColumn('__ArchiveDatetimeUTC', lit(archiveLog.ArchiveDatetimeUTC)) \
+                  .withColumns(getLineageColumns(archiveLog))
+
+# COMMAND ----------
+
+def loadChildTable(dfDocument, arrayColumn, parentKeyColumns, archiveLog, datetimeUtcNow):
+    childTable = __TARGET_TABLE + "_" + arrayColumn
+    childPath = __TARGET_PATH + "_" + arrayColumn
+    dfChild = getChildSource(dfDocument, arrayColumn, parentKeyColumns, archiveLog, datetimeUtcNow)
+    
+    if not targetTableExists(childTable):
+        print("Initial child table creation: " + childTable)
+        dfChild.write.format("delta") \
+              .option("path", childPath) \
+              .saveAsTable(__TARGET_DATABASE + "." + childTable)
+        targetTables[childTable.lower()] = True
+        return
+    
+    print("Insert, update & trim child table: " + childTable)
+    evolveTargetSchema(dfChild, childPath)
+    
+    # Last element position per parent key. Child rows above it no longer exist in parent array
+    dfChildTrim = dfDocument.select(*parentKeyColumns, when(col("`" + arrayColumn + "`").isNull(), lit(-1)).otherwise(size(col("`" + arrayColumn + "`")) - 1).alias("__MaxIndex"))
+    dfStaged = dfChild.withColumn("__MergeAction", lit("UPSERT")) \
+                      .unionByName(dfChildTrim.withColumn("__MergeAction", lit("TRIM")), allowMissingColumns = True)
+    
+    # Elements are upserted by position and trailing stale positions are deleted in single pass over child table
+    DeltaTable.forPath(spark, childPath).alias("t").merge(
+        dfStaged.alias("s"),
+        getMatchCondition(parentKeyColumns, "Match parent business keys") + " AND ((s.`__MergeAction` = 'UPSERT' AND s.`__Index` = t.`__Index`) OR (s.`__MergeAction` = 'TRIM' AND t.`__Index` > s.`__MaxIndex`))"
+    ).whenMatchedDelete(
+      condition = "s.`__MergeAction` = 'TRIM'"
+    ).whenMatchedUpdate(
+      condition = "s.`__HashDiff` != t.`__HashDiff`",
+      set = getColumnAssignments(dfChild.columns)
+    ).whenNotMatchedInsert(
+      condition = "s.`__MergeAction` = 'UPSERT'",
+      values = getColumnAssignments(dfChild.columns)
+    ).execute()
+
+# COMMAND ----------
+
+def getReplacedPartitions(dfSource, dfTarget, deleteCondition, datetimeUtcNow):
+    # Single full outer join of file rows and rows of replaced target partitions by business keys
+    dfJoined = dfSource.withColumn("__InFile", lit(True)).alias("s").join(
+        dfTarget.alias("t"),
+        expr(getMatchCondition(__TARGET_TABLE_BK_COLUMNS, "Match business keys")),
+        "full_outer"
+    )
+    
+    # File row is written when it is new, changed or deleted earlier. Unchanged target row is kept as it is
+    useSource = col("s.`__InFile`").isNotNull() & ~(col("t.`__HashDiff`").eqNullSafe(col("s.`__HashDiff`")) & col("t.`__DeletedDatetimeUTC`").isNull())
+    # Target row that does not exist in file is marked deleted
+    markDeleted = col("s.`__InFile`").isNull() & expr(deleteCondition)
+    
+    sourceColumns = [c.lower() for c in dfSource.columns]
+    targetColumns = [c.lower() for c in dfTarget.columns]
+    columns = []
+    for columnName in dfSource.columns:
+        sourceColumn = col("s.`" + columnName + "`")
+        targetColumn = col("t.`" + columnName + "`")
+        if columnName.lower() not in targetColumns:
+            columns.append(when(useSource, sourceColumn).alias(columnName))
+        elif columnName == '__DeletedDatetimeUTC':
+            columns.append(when(useSource, sourceColumn).when(markDeleted, lit(str(datetimeUtcNow))).otherwise(targetColumn).alias(columnName))
+        elif columnName == '__ModifiedDatetimeUTC':
+            columns.append(when(useSource, sourceColumn).when(markDeleted, lit(datetimeUtcNow)).otherwise(targetColumn).alias(columnName))
+        else:
+            columns.append(when(useSource, sourceColumn).otherwise(targetColumn).alias(columnName))
+    
+    for columnName in dfTarget.columns:
+        if columnName.lower() not in sourceColumns:
+            columns.append(col("t.`" + columnName + "`"))
+    
+    return dfJoined.select(*columns)
+
+# COMMAND ----------
+
+def getArchiveInputFileColumn():
+    # Input file of row comparable to archive file path. Input file name is URL encoded
+    return regexp_replace(expr("reflect('java.net.URLDecoder', 'decode', replace(input_file_name(), '+', '%2B'), 'UTF-8')"), "([^:])/+", "$1/")
+
+# COMMAND ----------
+
+def getSourceDigest(dfSource, digestColumns):
+    # Order independent digest of prepared rows and column names. Row hashes are summed so that row order of file does not matter
+    digest = dfSource.select(xxhash64(*digestColumns).alias("__RowHash"), xxhash64(lit(1), *digestColumns).alias("__RowHash2")) \
+                     .selectExpr("count(*)", "sum(CAST(`__RowHash` AS decimal(38,0)))", "sum(CAST(`__RowHash2` AS decimal(38,0)))") \
+                     .collect()[0]
+    return hashlib.sha256((",".join(sorted(dfSource.columns)) + "|" + "|".join([str(x) for x in digest])).encode("utf-8")).hexdigest()
+
+# COMMAND ----------
+
+def getLastSourceDigest():
+    # Digest of the last loaded archive file. Files loaded without digest do not match any digest
+    dfProcessLogs = spark.read.format("delta").load(__TARGET_LOG_PATH)
+    if "SourceDigest" not in dfProcessLogs.columns:
+        return None
+    
+    lastProcessLogs = dfProcessLogs.where("ArchiveFilePath IS NOT NULL") \
+                                   .orderBy(col("ArchiveDatetimeUTC").desc(), col("ProcessDatetime").desc()) \
+                                   .select("SourceDigest") \
+                                   .limit(1) \
+                                   .collect()
+    return lastProcessLogs[0][0] if lastProcessLogs else None
+
+# COMMAND ----------
+
+def addMetrics(phase, startTime, archiveLog = None, targetPath = None, operations = None, operationMetrics = None):
+    # Wall-clock time of phase. Delta operation metrics are taken from the commit that phase made on target path
+    if __METRICS_PATH == "":
+        return
+    
+    operation = ""
+    if targetPath is not None:
+        lastCommit = DeltaTable.forPath(spark, targetPath).history(1).select("version", "operation", "operationMetrics").collect()[0]
+        if metricsVersions.get(targetPath) != lastCommit.version and (operations is None or lastCommit.operation in operations):
+            operation = lastCommit.operation
+            operationMetrics = lastCommit.operationMetrics
+        metricsVersions[targetPath] = lastCommit.version
+    
+    metrics.append({
+      'RunId': __RUN_ID,
+      'Loader': "FromJsonArchiveToDatabricksFact",
+      'TargetTable': __TARGET_DATABASE + "." + __TARGET_TABLE,
+      'TargetPath': targetPath or '',
+      'ArchiveFilePath': archiveLog.ArchiveFilePath if archiveLog is not None else '',
+      'Phase': phase,
+      'EndDatetimeUTC': datetime.utcnow(),
+      'DurationSeconds': time.perf_counter() - startTime,
+      'Operation': operation,
+      'OperationMetrics': json.dumps(operationMetrics or {})
+    })
+
+# COMMAND ----------
+
+def initMetricsVersions(targetPaths):
+    # Latest commits before the run. Only commits made during the run are attributed to its phases
+    if __METRICS_PATH == "":
+        return
+    
+    for targetPath in targetPaths:
+        if DeltaTable.isDeltaTable(spark, targetPath):
+            metricsVersions[targetPath] = DeltaTable.forPath(spark, targetPath).history(1).select("version").collect()[0].version
+
+# COMMAND ----------
+
+def saveProcessLogs(processLogs):
+    # Process log is watermark of the load. Archive files of committed rows are not loaded again
+    dfProcessLogs = spark.createDataFrame(pd.DataFrame(processLogs)) \
+                       .selectExpr("CAST(ProcessDatetime AS timestamp) AS ProcessDatetime", \
+                                   "CAST(ArchiveDatetimeUTC AS timestamp) AS ArchiveDatetimeUTC", \
+                                   "CAST(OriginalStagingFilePath AS string) AS OriginalStagingFilePath", \
+                                   "CAST(OriginalStagingFileName AS string) AS OriginalStagingFileName", \
+                                   "CAST(OriginalStagingFileSize AS long) AS OriginalStagingFileSize", \
+                                   "CAST(ArchiveFilePath AS string) AS ArchiveFilePath", \
+                                   "CAST(ArchiveFileName AS string) AS ArchiveFileName", \
+                                   "xxhash64(CAST(ArchiveFilePath AS string)) AS ArchiveFileId", \
+                                   "CAST(NULLIF(SourceDigest, '') AS string) AS SourceDigest")
+    dfProcessLogs.write.format("delta") \
+                     .mode("append") \
+                     .option("mergeSchema", "true") \
+                     .save(__TARGET_LOG_PATH)
+
+# COMMAND ----------
+
+def deduplicateSource(dfSource, partitionColumns):
+    # One row per business key. Row position in file is used when no order is given
+    orderBy = __DEDUPLICATE_ORDER_BY
+    if orderBy == "":
+        dfSource = dfSource.withColumn("__RowPosition", expr("monotonically_increasing_id()"))
+        orderBy = "`__RowPosition` DESC"
+    
+    # Kept row carries the number of its dropped duplicates from the same window, so dropped rows are counted without reading the file again
+    window = "PARTITION BY " + ", ".join(partitionColumns) + " ORDER BY " + orderBy
+    return dfSource.withColumn("__DeduplicateRowNumber", expr("row_number() OVER (" + window + ")")) \
+                   .withColumn("__DeduplicateDroppedRows", expr("COUNT(1) OVER (" + window + " ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING) - 1")) \
+                   .where("`__DeduplicateRowNumber` = 1") \
+                   .drop("__DeduplicateRowNumber", "__RowPosition")
+
+# COMMAND ----------
+
+def getDeduplicateDroppedRows(dfSource):
+    # Summed from persisted source. Column is dropped before write
+    return dfSource.agg(expr("COALESCE(SUM(`__DeduplicateDroppedRows`), 0)")).collect()[0][0]
+
+# COMMAND ----------
+
+def transformSource(dfSource):
+    # User transformation is part of the same plan as read, hash diff and merge, so it costs no extra materialization
+    if __TRANSFORM_SQL != "":
+        dfSourceViewName = "tmp_" + str(uuid.uuid4()).replace('-', '_')
+        dfSource.createOrReplaceTempView(dfSourceViewName)
+        dfSource = spark.sql(__TRANSFORM_SQL.replace("{source}", "`" + dfSourceViewName + "`"))
+        
+        try:
+            spark.catalog.dropTempView(dfSourceViewName)
+        except:
+            pass
+    
+    if transformFunction is not None:
+        # Arrow batches are passed to function as pandas data frames
+        dfSource = dfSource.mapInPandas(transformFunction, dfSource.schema if __TRANSFORM_SCHEMA == "" else __TRANSFORM_SCHEMA)
+    
+    return dfSource
+
+# COMMAND ----------
+
+def getAppendTransactionVersion(archiveLog):
+    # Strictly increasing version of archive file under single transaction id of target table:
+    # archive datetime in microseconds and position among files archived at the same datetime
+    sameDatetimeFilePaths = [a.ArchiveFilePath for a in dfStaticArchiveLogs if a.ArchiveDatetimeUTC == archiveLog.ArchiveDatetimeUTC]
+    return ((archiveLog.ArchiveDatetimeUTC - datetime(1970, 1, 1)) // timedelta(microseconds = 1)) * 1000 + sameDatetimeFilePaths.index(archiveLog.ArchiveFilePath)
+
+# COMMAND ----------
+
+targetTables = {}
+
+def targetTableExists(tableName):
+    # Existence is resolved from catalog once per table and run instead of listing all tables of database per archive file
+    if tableName.lower() not in targetTables:
+        targetTables[tableName.lower()] = spark.catalog.tableExists(tableName, __TARGET_DATABASE)
+    return targetTables[tableName.lower()]
+
+# COMMAND ----------
+
+def getLineageColumns(archiveLog):
+    # Compact lineage stores id of archive file instead of path strings repeated on every row
+    if __COMPACT_LINEAGE == "TRUE":
+        return { '__ArchiveFileId': xxhash64(lit(archiveLog.ArchiveFilePath)) }
+    
+    return {
+        '__ArchiveFilePath': lit(archiveLog.ArchiveFilePath),
+        '__OriginalStagingFileName': lit(archiveLog.OriginalStagingFileName)
+    }
+
+# COMMAND ----------
+
+def createLineageView(tableName, tablePath):
+    # Process log is lineage dimension of archive files. View is re-created on each run as its columns are fixed at creation
+    spark.sql("""
+      CREATE OR REPLACE VIEW `""" + __TARGET_DATABASE + """`.`""" + tableName + """_lineage`
+      AS
+      SELECT t.*, l.ArchiveFilePath AS `__ArchiveFilePath`, l.OriginalStagingFileName AS `__OriginalStagingFileName`
+      FROM delta.`""" + tablePath + """` t
+      LEFT JOIN (
+        SELECT DISTINCT COALESCE(ArchiveFileId, xxhash64(ArchiveFilePath)) AS ArchiveFileId, ArchiveFilePath, OriginalStagingFileName
+        FROM delta.`""" + __TARGET_LOG_PATH + """`
+        WHERE ArchiveFilePath IS NOT NULL
+      ) l ON t.`__ArchiveFileId` = l.ArchiveFileId
+     """)
+
+# COMMAND ----------
+
+def getArchiveFileLineage(archiveLogs):
+    # Archive files in processing order as lookup for rows read from several archive files at once
+    archiveFiles = []
+    for archiveFileSequence, archiveLog in enumerate(archiveLogs):
+        archiveFiles.append({
+          '__ArchiveInputFile': archiveLog.ArchiveFilePath,
+          '__ArchiveFileSequence': archiveFileSequence,
+          '__ArchiveDatetimeUTC': archiveLog.ArchiveDatetimeUTC,
+          '__ArchiveFilePath': archiveLog.ArchiveFilePath,
+          '__OriginalStagingFileName': archiveLog.OriginalStagingFileName
+        })
+    
+    return spark.createDataFrame(pd.DataFrame(archiveFiles)) \
+                .selectExpr("regexp_replace(CAST(__ArchiveInputFile AS string), '([^:])/+', '$1/') AS __ArchiveInputFile", \
+                            "CAST(__ArchiveFileSequence AS int) AS __ArchiveFileSequence", \
+                            "CAST(__ArchiveDatetimeUTC AS timestamp) AS __ArchiveDatetimeUTC", \
+                            "CAST(__ArchiveFilePath AS string) AS __ArchiveFilePath", \
+                            "CAST(__OriginalStagingFileName AS string) AS __OriginalStagingFileName", \
+                            "xxhash64(CAST(__ArchiveFilePath AS string)) AS __ArchiveFileId")
+
+# COMMAND ----------
+
+def addArchiveFileLineage(dfSource, dfArchiveFiles):
+    # Archive file columns by input file of row. Result is materialized as all later phases of backfill reuse it
+    dfSource = dfSource.join(broadcast(dfArchiveFiles), "__ArchiveInputFile", "left").persist(StorageLevel.MEMORY_AND_DISK)
+    
+    unmatchedInputFiles = dfSource.where("`__ArchiveFileSequence` IS NULL").select("__ArchiveInputFile").limit(1).collect()
+    if unmatchedInputFiles:
+        raise Exception("Input file not found from archive log: " + str(unmatchedInputFiles[0][0]))
+    
+    return dfSource
+
+# COMMAND ----------
+
+def getScopeFileRanks(dfRows, dfSource, scopeColumns, dfArchiveFiles):
+    # Rank of row file among files of its delete scope and archive datetime of the next file in the scope
+    # Scope is all archive files or, with scope columns, archive files having the same scope column values
+    if scopeColumns:
+        dfScopeFiles = dfSource.select(*scopeColumns, "__ArchiveFileSequence").distinct()
+        scopeWindow = Window.partitionBy(*scopeColumns).orderBy("__ArchiveFileSequence")
+    else:
+        scopeColumns = []
+        dfScopeFiles = dfArchiveFiles.select("__ArchiveFileSequence")
+        scopeWindow = Window.orderBy("__ArchiveFileSequence")
+    
+    dfScopeFiles = dfScopeFiles.join(dfArchiveFiles.select("__ArchiveFileSequence", "__ArchiveDatetimeUTC"), "__ArchiveFileSequence") \
+                               .withColumn("__ScopeRank", row_number().over(scopeWindow)) \
+                               .withColumn("__ScopeNextArchiveDatetimeUTC", lead("__ArchiveDatetimeUTC").over(scopeWindow)) \
+                               .drop("__ArchiveDatetimeUTC")
+    
+    scopeCondition = " AND ".join(["r.`__ArchiveFileSequence` = f.`__ArchiveFileSequence`"] + ["r." + c + " <=> f." + c for c in scopeColumns])
+    return dfRows.alias("r").join(broadcast(dfScopeFiles.alias("f")), expr(scopeCondition)) \
+                 .select("r.*", "f.`__ScopeRank`", "f.`__ScopeNextArchiveDatetimeUTC`")
+
+# COMMAND ----------
+
+def getBackfillSource(archiveFilePaths):
+    # Archive files read at once with input file of each row
+    if jsonSchema is None:
+        dfSource = spark.read.json(archiveFilePaths)
+    else:
+        dfSource = spark.read.schema(jsonSchema).json(archiveFilePaths)
+    
+    if __FLATTEN_STRUCTS == "TRUE":
+        dfSource = dfSource.select(*getFlattenedColumns(dfSource.schema, __FLATTEN_MAX_DEPTH, __FLATTEN_SEPARATOR))
+    
+    if __COMPLEX_AS_STRING.strip().upper() == 'TRUE':
+        dfSource = dfSource.select(*[col("`" + c[0] + "`").cast((c[1].startswith("array<") or c[1].startswith("struct")) and 'string' or c[1]) for c in dfSource.dtypes])
+    
+    dfSource = dfSource.withColumn("__ArchiveInputFile", getArchiveInputFileColumn())
+    
+    if __EXTRACT_COLUMNS != '*' or __PARTITION_BY_COLUMNS_PRE_SQL != "":
+        dfSourceViewName = 'temp_' + str(uuid.uuid4()).replace('-', '_')
+        dfSource.createOrReplaceTempView(dfSourceViewName)
+        
+        selectColumns = [__EXTRACT_COLUMNS]
+        if __PARTITION_BY_COLUMNS_PRE_SQL != "":
+            selectColumns.append(__PARTITION_BY_COLUMNS_PRE_SQL)
+        if __EXTRACT_COLUMNS.strip() != "*":
+            selectColumns.append("`__ArchiveInputFile`")
+        dfSource = spark.sql("SELECT " + ", ".join(selectColumns) + " FROM `" + dfSourceViewName + "`")
+        
+        try:
+            spark.catalog.dropTempView(dfSourceViewName)
+        except:
+            pass
+    
+    for columnToExclude in __EXCLUDE_COLUMNS:
+        dfSource = dfSource.drop(col(columnToExclude))
+    
+    return dfSource
+
+# COMMAND ----------
+
+def ensureDataSkippingStats(targetPath, columns):
+    # Min/max statistics are collected only for the first dataSkippingNumIndexedCols leaf columns. Clustering columns must be within them
+    tableProperties = spark.sql("DESCRIBE DETAIL delta.`" + targetPath + "`").collect()[0]["properties"]
+    if "delta.dataSkippingStatsColumns" in tableProperties:
+        return
+    
+    numIndexedCols = int(tableProperties.get("delta.dataSkippingNumIndexedCols", "32"))
+    if numIndexedCols < 0:
+        return
+    
+    def getLeafColumnCount(dataType):
+        if isinstance(dataType, StructType):
+            return sum(getLeafColumnCount(f.dataType) for f in dataType.fields)
+        return 1
+    
+    leafColumnPositions = {}
+    leafColumnPosition = 0
+    for field in DeltaTable.forPath(spark, targetPath).toDF().schema.fields:
+        leafColumnPosition += getLeafColumnCount(field.dataType)
+        leafColumnPositions[field.name.lower()] = leafColumnPosition
+    
+    requiredNumIndexedCols = max(leafColumnPositions.get(c.strip('`').lower(), 0) for c in columns)
+    if requiredNumIndexedCols > numIndexedCols:
+        print("Collect statistics for first " + str(requiredNumIndexedCols) + " columns. Applies to files written from now on")
+        spark.sql("ALTER TABLE delta.`" + targetPath + "` SET TBLPROPERTIES ('delta.dataSkippingNumIndexedCols' = '" + str(requiredNumIndexedCols) + "')")
+
+# COMMAND ----------
+
+def isMaintenanceDue(targetPath):
+    # Per-run OPTIMIZE rewrites the whole table when only a few new files exist. AUTO optimizes when small files have accumulated
+    if __MAINTENANCE_MODE == "ALWAYS":
+        return True
+    if __MAINTENANCE_MODE == "NONE":
+        print("Maintenance is skipped by maintenance mode")
+        return False
+    
+    tableDetail = spark.sql("DESCRIBE DETAIL delta.`" + targetPath + "`").collect()[0]
+    numFiles = tableDetail["numFiles"] or 0
+    averageFileSize = (tableDetail["sizeInBytes"] or 0) / numFiles if numFiles > 0 else 0
+    if numFiles >= __MAINTENANCE_MIN_FILES and averageFileSize < __MAINTENANCE_SMALL_FILE_SIZE:
+        return True
+    
+    print("Maintenance is not due: " + str(numFiles) + " files, average file size " + str(int(averageFileSize)) + " bytes")
+    return False
+
+# COMMAND ----------
+
+def optimizeTable(targetPath, clusteringColumns, partitionColumns):
+    # Rows are clustered by business keys so that merge file pruning rewrites only a fraction of files
+    partitionColumnNames = [c.strip('`').lower() for c in (partitionColumns or [])]
+    clusteringColumns = [c for c in clusteringColumns if c.strip('`').lower() not in partitionColumnNames]
+    
+    if __TARGET_CLUSTERING == "NONE" or not clusteringColumns:
+        if isMaintenanceDue(targetPath):
+            spark.sql('OPTIMIZE delta.`' + targetPath + '`').display()
+        return
+    
+    ensureDataSkippingStats(targetPath, clusteringColumns)
+    
+    if __TARGET_CLUSTERING == "LIQUID" and not partitionColumnNames:
+        tableDetail = spark.sql("DESCRIBE DETAIL delta.`" + targetPath + "`").collect()[0].asDict()
+        if [c.lower() for c in (tableDetail.get("clusteringColumns") or [])] != [c.strip('`').lower() for c in clusteringColumns]:
+            print("Cluster by: " + ", ".join(clusteringColumns))
+            spark.sql("ALTER TABLE delta.`" + targetPath + "` CLUSTER BY (" + ", ".join(clusteringColumns) + ")")
+        if isMaintenanceDue(targetPath):
+            spark.sql('OPTIMIZE delta.`' + targetPath + '`').display()
+    else:
+        if __TARGET_CLUSTERING == "LIQUID":
+            print("Liquid clustering is not supported with partitioned table, using Z-order")
+        # Z-order columns are stored as table property for System/DeltaMaintenance notebook
+        zOrderByColumns = ", ".join(clusteringColumns)
+        tableProperties = spark.sql("DESCRIBE DETAIL delta.`" + targetPath + "`").collect()[0]["properties"]
+        if tableProperties.get("ada.zOrderByColumns") != zOrderByColumns:
+            spark.sql("ALTER TABLE delta.`" + targetPath + "` SET TBLPROPERTIES ('ada.zOrderByColumns' = '" + zOrderByColumns + "')")
+        if isMaintenanceDue(targetPath):
+            spark.sql('OPTIMIZE delta.`' + targetPath + '` ZORDER BY (' + zOrderByColumns + ')').display()
+
+# COMMAND ----------
+
 # Get archive log records where ArchiveDatetimeUTC is greater than lastArchiveDatetimeUTC
 try:
     dfArchiveLogs = spark.sql(" \
@@ -257,10 +1017,175 @@ if __PARTITION_BY_COLUMNS != '':
 else:
     __PARTITION_BY_COLUMNS = None
 
+__HASH_DIFF_ALGORITHM = __HASH_DIFF_ALGORITHM.strip().upper()
+__HASH_DIFF_DATA_TYPES = { "SHA256": "string", "SHA256_BINARY": "binary", "XXHASH64": "bigint" }
+if __HASH_DIFF_ALGORITHM not in __HASH_DIFF_DATA_TYPES:
+    raise Exception("Unsupported hash diff algorithm: " + __HASH_DIFF_ALGORITHM)
+print("Hash diff algorithm: " + __HASH_DIFF_ALGORITHM)
+
+# Hash diff data type cannot be changed on existing target table
+if DeltaTable.isDeltaTable(spark, __TARGET_PATH):
+    targetHashDiffDataType = DeltaTable.forPath(spark, __TARGET_PATH).toDF().schema["__HashDiff"].dataType.simpleString()
+    if targetHashDiffDataType != __HASH_DIFF_DATA_TYPES[__HASH_DIFF_ALGORITHM]:
+        raise Exception("Target __HashDiff data type '" + targetHashDiffDataType + "' does not match hash diff algorithm " + __HASH_DIFF_ALGORITHM)
+
+__LOAD_MODE = __LOAD_MODE.strip().upper()
+if __LOAD_MODE not in ["MERGE", "APPEND_ONLY", "REPLACE_PARTITIONS"]:
+    raise Exception("Unsupported load mode: " + __LOAD_MODE)
+print("Load mode: " + __LOAD_MODE)
+if __LOAD_MODE == "REPLACE_PARTITIONS" and __PARTITION_BY_COLUMNS is None:
+    raise Exception("Partition by columns are required with REPLACE_PARTITIONS load mode")
+
+__APPEND_IDEMPOTENT = __APPEND_IDEMPOTENT.strip().upper()
+if __LOAD_MODE == "APPEND_ONLY" and __DELETE_FILTER_COLUMNS is not None:
+    print("Delete filter columns are not used with APPEND_ONLY load mode")
+
+__FLATTEN_STRUCTS = __FLATTEN_STRUCTS.strip().upper()
+__FLATTEN_MAX_DEPTH = int(__FLATTEN_MAX_DEPTH)
+if __FLATTEN_STRUCTS == "TRUE":
+    print("Flatten structs with max depth " + str(__FLATTEN_MAX_DEPTH) + " and separator '" + __FLATTEN_SEPARATOR + "'")
+
+if __EXPLODE_ARRAYS != '':
+    __EXPLODE_ARRAYS = __EXPLODE_ARRAYS.replace('[', '').replace(']', '').replace('`', '')
+    __EXPLODE_ARRAYS = [x.strip() for x in __EXPLODE_ARRAYS.split(',')]
+    print("Explode arrays to child tables: " + ", ".join(__EXPLODE_ARRAYS))
+else:
+    __EXPLODE_ARRAYS = []
+
+__JSON_SCHEMA_CACHE = __JSON_SCHEMA_CACHE.strip().upper()
+jsonSchema = None
+if __JSON_SCHEMA_CACHE == "TRUE":
+    try:
+        jsonSchema = StructType.fromJson(json.loads(spark.read.text(__JSON_SCHEMA_CACHE_PATH, wholetext = True).first()[0]))
+        print("Using cached JSON schema: " + __JSON_SCHEMA_CACHE_PATH)
+    except AnalysisException:
+        print("No cached JSON schema, schema is inferred from first file")
+
 print("Update filter: " + __UPDATE_FILTER)
 
+if __BACKFILL == "TRUE":
+    # Backfill builds target table from scratch
+    if DeltaTable.isDeltaTable(spark, __TARGET_PATH):
+        raise Exception("Backfill requires that target table does not exist: " + __TARGET_PATH)
+    if __EXPLODE_ARRAYS:
+        raise Exception("Backfill is not supported with exploded arrays")
+    print("Backfill from archive files archived after " + str(__BACKFILL_START_DATETIME))
+
+__TARGET_CLUSTERING = __TARGET_CLUSTERING.strip().upper()
+if __TARGET_CLUSTERING not in ["ZORDER", "LIQUID", "NONE"]:
+    raise Exception("Unsupported target clustering: " + __TARGET_CLUSTERING)
+print("Target clustering: " + __TARGET_CLUSTERING)
+
+__MAINTENANCE_MODE = __MAINTENANCE_MODE.strip().upper()
+if __MAINTENANCE_MODE not in ["AUTO", "ALWAYS", "NONE"]:
+    raise Exception("Unsupported maintenance mode: " + __MAINTENANCE_MODE)
+print("Maintenance mode: " + __MAINTENANCE_MODE)
+
+__COMPACT_LINEAGE = __COMPACT_LINEAGE.strip().upper()
+__LINEAGE_COLUMNS = ['__ArchiveFileId'] if __COMPACT_LINEAGE == "TRUE" else ['__ArchiveFilePath', '__OriginalStagingFileName']
+if DeltaTable.isDeltaTable(spark, __TARGET_PATH) and __LINEAGE_COLUMNS[0] not in spark.read.format("delta").load(__TARGET_PATH).columns:
+    raise Exception("Compact lineage does not match lineage columns of existing target table: " + __TARGET_PATH)
+print("Compact lineage: " + __COMPACT_LINEAGE)
+
+__DEDUPLICATE = __DEDUPLICATE.strip().upper()
+__DEDUPLICATE_ORDER_BY = __DEDUPLICATE_ORDER_BY.strip()
+if __DEDUPLICATE == "TRUE":
+    print("Deduplicate by business key with order: " + (__DEDUPLICATE_ORDER_BY if __DEDUPLICATE_ORDER_BY != "" else "last occurrence in file"))
+
+__TRANSFORM_SQL = __TRANSFORM_SQL.strip()
+if __TRANSFORM_SQL != "":
+    if "{source}" not in __TRANSFORM_SQL:
+        raise Exception("Transform SQL must select from {source}")
+    print("Transform SQL: " + __TRANSFORM_SQL)
+
+__TRANSFORM_FUNCTION = __TRANSFORM_FUNCTION.strip()
+__TRANSFORM_SCHEMA = __TRANSFORM_SCHEMA.strip()
+transformFunction = None
+if __TRANSFORM_FUNCTION != "":
+    if __TRANSFORM_FUNCTION.count(":") != 1:
+        raise Exception("Transform function must be given as module:function: " + __TRANSFORM_FUNCTION)
+    transformModuleName, transformFunctionName = [p.strip() for p in __TRANSFORM_FUNCTION.split(":")]
+    transformFunction = getattr(importlib.import_module(transformModuleName), transformFunctionName)
+    print("Transform function: " + __TRANSFORM_FUNCTION + (" with schema " + __TRANSFORM_SCHEMA if __TRANSFORM_SCHEMA != "" else ""))
+
+__PROCESS_LOG_COMMIT_INTERVAL = int(__PROCESS_LOG_COMMIT_INTERVAL)
+print("Process log commit interval: " + str(__PROCESS_LOG_COMMIT_INTERVAL))
+
+__SKIP_UNCHANGED = __SKIP_UNCHANGED.strip().upper()
+if __SKIP_UNCHANGED == "TRUE" and __LOAD_MODE == "APPEND_ONLY":
+    # Appended rows of equal file are intended duplicates
+    print("Skip unchanged is not used with APPEND_ONLY load mode")
+    __SKIP_UNCHANGED = "FALSE"
+lastSourceDigest = None
+if __SKIP_UNCHANGED == "TRUE":
+    lastSourceDigest = getLastSourceDigest()
+    print("Skip unchanged files. Last source digest: " + str(lastSourceDigest))
+
+spark.sql("CREATE DATABASE IF NOT EXISTS " + __TARGET_DATABASE)
+
 processLogs = []
+committedProcessLogs = 0
 dfStaticArchiveLogs = dfArchiveLogs.collect()
+initMetricsVersions([__TARGET_PATH, __TARGET_LOG_PATH] + [__TARGET_PATH + "_" + arrayColumn for arrayColumn in __EXPLODE_ARRAYS])
+if __BACKFILL == "TRUE" and dfStaticArchiveLogs:
+    print("Backfill " + str(len(dfStaticArchiveLogs)) + " archive files in single load")
+    phaseStartTime = time.perf_counter()
+    dfArchiveFiles = getArchiveFileLineage(dfStaticArchiveLogs)
+    dfSource = getBackfillSource([archiveLog.ArchiveFilePath for archiveLog in dfStaticArchiveLogs])
+    dfSource = transformSource(dfSource)
+    if "__ArchiveInputFile" not in dfSource.columns:
+        raise Exception("Transformation must keep column __ArchiveInputFile in backfill e.g. SELECT *")
+    
+    dfSource = dfSource.withColumn('__DeletedDatetimeUTC', lit(None).cast(StringType()))
+    if __DEDUPLICATE == "TRUE":
+        # Duplicates are removed within each archive file
+        dfSource = deduplicateSource(dfSource, __TARGET_TABLE_BK_COLUMNS + ["`__ArchiveInputFile`"])
+    
+    dfSource = dfSource.withColumn("__HashDiff", getHashDiffColumn([c for c in dfSource.columns if c not in ['__DeletedDatetimeUTC', '__ArchiveInputFile', '__DeduplicateDroppedRows']], __HASH_DIFF_ALGORITHM))
+    datetimeUtcNow = datetime.utcnow()
+    
+    dfSource = dfSource.withColumn('__ModifiedDatetimeUTC', lit(datetimeUtcNow))
+    preparedColumns = [c for c in dfSource.columns if c not in ['__ArchiveInputFile', '__DeduplicateDroppedRows']] + ['__ArchiveDatetimeUTC'] + __LINEAGE_COLUMNS
+    dfBackfill = addArchiveFileLineage(dfSource, dfArchiveFiles)
+    if __DEDUPLICATE == "TRUE":
+        # Sum reads persisted backfill source that later phases reuse
+        print("Deduplicate dropped rows: " + str(getDeduplicateDroppedRows(dfBackfill)))
+    
+    if __LOAD_MODE == "APPEND_ONLY":
+        dfTarget = dfBackfill.select(*preparedColumns)
+    else:
+        # Final state of business key is its row in the last archive file
+        dfTarget = dfBackfill.withColumn("__RowNumber", row_number().over(Window.partitionBy(*__TARGET_TABLE_BK_COLUMNS).orderBy(col("__ArchiveFileSequence").desc()))) \
+                             .where("`__RowNumber` = 1")
+        
+        # Business key is deleted when a later archive file of its delete scope does not contain it
+        scopeColumns = (__PARTITION_BY_COLUMNS if __LOAD_MODE == "REPLACE_PARTITIONS" else []) + (__DELETE_FILTER_COLUMNS or [])
+        dfTarget = getScopeFileRanks(dfTarget, dfBackfill, scopeColumns, dfArchiveFiles) \
+                       .withColumn('__DeletedDatetimeUTC', when(col("__ScopeNextArchiveDatetimeUTC").isNotNull(), lit(str(datetimeUtcNow))).otherwise(col('__DeletedDatetimeUTC'))) \
+                       .select(*preparedColumns)
+    
+    dfWriter = dfTarget.write.format("delta").option("path", __TARGET_PATH)
+    if __PARTITION_BY_COLUMNS is not None:
+        dfWriter = dfWriter.partitionBy(__PARTITION_BY_COLUMNS)
+    dfWriter.saveAsTable(__TARGET_DATABASE + "." + __TARGET_TABLE)
+    addMetrics("BACKFILL", phaseStartTime, None, __TARGET_PATH)
+    dfBackfill.unpersist()
+    
+    for archiveLog in dfStaticArchiveLogs:
+        processLogs.append({
+          'ProcessDatetime': datetime.utcnow(),
+          'ArchiveDatetimeUTC': archiveLog.ArchiveDatetimeUTC,
+          'OriginalStagingFilePath': archiveLog.OriginalStagingFilePath,
+          'OriginalStagingFileName': archiveLog.OriginalStagingFileName,
+          'OriginalStagingFileSize': archiveLog.OriginalStagingFileSize,
+          'ArchiveFilePath': archiveLog.ArchiveFilePath,
+          'ArchiveFileName': archiveLog.ArchiveFileName,
+          'SourceDigest': ''
+        })
+    
+    # All archive files are loaded, no file by file processing
+    dfStaticArchiveLogs = []
+
 for archiveLog in dfStaticArchiveLogs:
     print("Processing file: " + archiveLog.ArchiveFilePath)
     processLogs.append({
@@ -270,15 +1195,27 @@ for archiveLog in dfStaticArchiveLogs:
       'OriginalStagingFileName': archiveLog.OriginalStagingFileName,
       'OriginalStagingFileSize': archiveLog.OriginalStagingFileSize,
       'ArchiveFilePath': archiveLog.ArchiveFilePath,
-      'ArchiveFileName': archiveLog.ArchiveFileName
+      'ArchiveFileName': archiveLog.ArchiveFileName,
+      'SourceDigest': ''
     })
+    phaseStartTime = time.perf_counter()
   
     # Read JSON file as it is
-    dfSource = spark.read.json(archiveLog.ArchiveFilePath)
+    if jsonSchema is None:
+        dfSource = spark.read.json(archiveLog.ArchiveFilePath)
+        if __JSON_SCHEMA_CACHE in ["TRUE", "REFRESH"]:
+            jsonSchema = dfSource.schema
+            dbutils.fs.put(__JSON_SCHEMA_CACHE_PATH, jsonSchema.json(), True)
+            print("Stored JSON schema: " + __JSON_SCHEMA_CACHE_PATH)
+    else:
+        dfSource = spark.read.schema(jsonSchema).json(archiveLog.ArchiveFilePath)
+    
+    if __FLATTEN_STRUCTS == "TRUE":
+        dfSource = dfSource.select(*getFlattenedColumns(dfSource.schema, __FLATTEN_MAX_DEPTH, __FLATTEN_SEPARATOR))
   
     if __COMPLEX_AS_STRING.strip().upper() == 'TRUE':
-        # Convert all columns with data type 'array' or 'struct' to data type string
-        dfSource = dfSource.select(*[col(c[0]).cast((c[1].startswith("array<") or c[1].startswith("struct")) and 'string' or c[1]) for c in dfSource.dtypes])
+        # Convert all columns with data type 'array' or 'struct' to data type string. Arrays exploded to child tables are kept
+        dfSource = dfSource.select(*[col("`" + c[0] + "`").cast((c[0] not in __EXPLODE_ARRAYS and (c[1].startswith("array<") or c[1].startswith("struct"))) and 'string' or c[1]) for c in dfSource.dtypes])
   
     if __EXTRACT_COLUMNS != '*' or __PARTITION_BY_COLUMNS_PRE_SQL != "":
         # Create temporary view for JSON data
@@ -300,45 +1237,98 @@ for archiveLog in dfStaticArchiveLogs:
     for columnToExclude in __EXCLUDE_COLUMNS:
         dfSource = dfSource.drop(col(columnToExclude))
     
+    dfSource = transformSource(dfSource)
+    
+    if __DEDUPLICATE == "TRUE":
+        dfSource = deduplicateSource(dfSource, __TARGET_TABLE_BK_COLUMNS)
+    
+    dfDocument = None
+    if __EXPLODE_ARRAYS:
+        # Parent and child tables are loaded from same parsed document
+        dfDocument = dfSource.persist(StorageLevel.MEMORY_AND_DISK)
+        dfSource = dfDocument.drop(*__EXPLODE_ARRAYS)
+    
     dfSource = dfSource.withColumn('__DeletedDatetimeUTC', lit(None).cast(StringType()))
-    dfSource = dfSource.withColumn('__tempStringForHashDiff', to_json(struct(col("*"))))
-    dfSource = dfSource.withColumn("__HashDiff", sha2(col("__tempStringForHashDiff"), 256))
-    dfSource = dfSource.drop(col("__tempStringForHashDiff"))
+    dfSource = dfSource.withColumn("__HashDiff", getHashDiffColumn([c for c in dfSource.columns if c not in ['__DeletedDatetimeUTC', '__DeduplicateDroppedRows']], __HASH_DIFF_ALGORITHM))
     datetimeUtcNow = datetime.utcnow()
-  
-    spark.sql("CREATE DATABASE IF NOT EXISTS " + __TARGET_DATABASE)
-    if (__TARGET_TABLE_FULLY_QUALIEFIED_NAME.lower() in ['`' + __TARGET_DATABASE.lower() + '`.`' + t.name.lower() + '`' for t in spark.catalog.listTables(__TARGET_DATABASE)]) == False:
+
+    dfSource = dfSource.withColumn('__ModifiedDatetimeUTC', lit(datetimeUtcNow)) \
+                       .withColumn('__ArchiveDatetimeUTC', lit(archiveLog.ArchiveDatetimeUTC)) \
+                       .withColumns(getLineageColumns(archiveLog))
+
+    # Materialize prepared source once per file. Partition, merge and delete conditions reuse it
+    dfPreparedSource = dfSource.persist(StorageLevel.MEMORY_AND_DISK)
+
+    if __DEDUPLICATE == "TRUE":
+        # Sum materializes persisted source that merge reuses
+        print("Deduplicate dropped rows: " + str(getDeduplicateDroppedRows(dfPreparedSource)))
+    dfSource = dfPreparedSource.drop("__DeduplicateDroppedRows")
+
+    if __METRICS_PATH != "":
+        # Materialize cached source so that read and hash time is not reported as merge time
+        numSourceRows = dfSource.count()
+        addMetrics("READ", phaseStartTime, archiveLog, operationMetrics = { 'numSourceRows': str(numSourceRows) })
+        phaseStartTime = time.perf_counter()
+
+    if __SKIP_UNCHANGED == "TRUE":
+        # Exploded arrays are part of digest through parsed document
+        if dfDocument is None:
+            sourceDigest = getSourceDigest(dfSource, [col("__HashDiff")])
+        else:
+            sourceDigest = getSourceDigest(dfDocument, [col("`" + c + "`") for c in dfDocument.columns if c != "__DeduplicateDroppedRows"])
+        processLogs[-1]['SourceDigest'] = sourceDigest
+        addMetrics("DIGEST", phaseStartTime, archiveLog)
+        phaseStartTime = time.perf_counter()
+        if sourceDigest == lastSourceDigest:
+            print("Skip unchanged file. Rows are equal to the last loaded file")
+            dfPreparedSource.unpersist()
+            if dfDocument is not None:
+                dfDocument.unpersist()
+            continue
+        lastSourceDigest = sourceDigest
+
+    if not targetTableExists(__TARGET_TABLE):
         print("Initial table creation")
     
         if __PARTITION_BY_COLUMNS is None:
             # Initial table creation without partition
-            dfSource.withColumn('__ModifiedDatetimeUTC', lit(datetimeUtcNow)) \
-                  .withColumn('__ArchiveDatetimeUTC', lit(archiveLog.ArchiveDatetimeUTC)) \
-                  .withColumn('__ArchiveFilePath', lit(archiveLog.ArchiveFilePath)) \
-                  .withColumn('__OriginalStagingFileName', lit(archiveLog.OriginalStagingFileName)) \
-                  .write.format("delta") \
+            dfSource.write.format("delta") \
                   .option("path", __TARGET_PATH) \
                   .saveAsTable(__TARGET_DATABASE + "." + __TARGET_TABLE)
         else:
             # Initial table creation with partition
-            dfSource.withColumn('__ModifiedDatetimeUTC', lit(datetimeUtcNow)) \
-                  .withColumn('__ArchiveDatetimeUTC', lit(archiveLog.ArchiveDatetimeUTC)) \
-                  .withColumn('__ArchiveFilePath', lit(archiveLog.ArchiveFilePath)) \
-                  .withColumn('__OriginalStagingFileName', lit(archiveLog.OriginalStagingFileName)) \
-                  .write.format("delta") \
+            dfSource.write.format("delta") \
                   .option("path", __TARGET_PATH) \
                   .partitionBy(__PARTITION_BY_COLUMNS) \
                   .saveAsTable(__TARGET_DATABASE + "." + __TARGET_TABLE)
+        targetTables[__TARGET_TABLE.lower()] = True
+    elif __LOAD_MODE == "APPEND_ONLY":
+        print("Append")
+        # Blind append without join to target table
+        dfWriter = dfSource.write.format("delta").mode("append").option("mergeSchema", "true")
+        if __APPEND_IDEMPOTENT == "TRUE":
+            # Delta skips the write when the same or later archive file is already committed to target
+            # One transaction id per target keeps Delta log state from growing with every archive file
+            dfWriter = dfWriter.option("txnAppId", __TARGET_PATH).option("txnVersion", getAppendTransactionVersion(archiveLog))
+        dfWriter.save(__TARGET_PATH)
+    elif __LOAD_MODE == "REPLACE_PARTITIONS":
+        print("Replace partitions")
+        # Partitions in file as predicate. Only those partitions are read and overwritten atomically
+        replaceCondition = getValuesCondition(dfSource, __PARTITION_BY_COLUMNS, "Replace partitions", None)
+        print("Replace condition: " + replaceCondition)
+        
+        dfTarget = DeltaTable.forPath(spark, __TARGET_PATH).toDF().where(replaceCondition)
+        getReplacedPartitions(dfSource, dfTarget, getDeleteCondition(dfSource, __DELETE_FILTER_COLUMNS), datetimeUtcNow).write.format("delta") \
+              .mode("overwrite") \
+              .option("replaceWhere", replaceCondition) \
+              .option("mergeSchema", "true") \
+              .save(__TARGET_PATH)
     else:
         print("Insert & update")
         # Insert & update to existing table
         deltaTable = DeltaTable.forPath(spark, __TARGET_PATH)
         deltaTable.alias("t").merge(
-            dfSource.withColumn('__ModifiedDatetimeUTC', lit(datetimeUtcNow)) \
-                    .withColumn('__ArchiveDatetimeUTC', lit(archiveLog.ArchiveDatetimeUTC)) \
-                    .withColumn('__ArchiveFilePath', lit(archiveLog.ArchiveFilePath)) \
-                    .withColumn('__OriginalStagingFileName', lit(archiveLog.OriginalStagingFileName)) \
-                    .alias("s"),
+            dfSource.alias("s"),
             getMatchCondition(__TARGET_TABLE_BK_COLUMNS, "Match business keys") + getPartitionCondition(dfSource, __PARTITION_BY_COLUMNS, "Match partition keys")
         ).whenMatchedUpdateAll(  
           condition = "s.`__HashDiff` != t.`__HashDiff`" + __UPDATE_FILTER
@@ -348,83 +1338,99 @@ for archiveLog in dfStaticArchiveLogs:
               '__DeletedDatetimeUTC' : lit(None).cast(StringType()),
               '__ModifiedDatetimeUTC': lit(datetimeUtcNow),
               '__ArchiveDatetimeUTC': lit(archiveLog.ArchiveDatetimeUTC),
-              '__ArchiveFilePath': lit(archiveLog.ArchiveFilePath),
-              '__OriginalStagingFileName': lit(archiveLog.OriginalStagingFileName)
+              **getLineageColumns(archiveLog)
           }
         ).whenNotMatchedInsertAll(
+        ).whenNotMatchedBySourceUpdate(
+          condition = getDeleteCondition(dfSource, __DELETE_FILTER_COLUMNS),
+          set = {
+              '__DeletedDatetimeUTC': lit(str(datetimeUtcNow)),
+              '__ModifiedDatetimeUTC': lit(datetimeUtcNow)
+          }
         ).execute()
     
-    # Mark deleted records with __DeletedDatetimeUTC
-    # Record is considered deleted if it exists in target table but does not exists in source (archive record)
-    print("Setting __DeletedDatetimeUTC if necessary")
-    if __DELETE_FILTER_COLUMNS is None:
-        setDeletedDatetimeUtcSql = """
-          UPDATE """ + __TARGET_DATABASE + "." + __TARGET_TABLE + """ AS d
-          SET    d.__DeletedDatetimeUTC = '""" + str(datetimeUtcNow) + """',
-                 d.__ModifiedDatetimeUTC = '""" + str(datetimeUtcNow) + """'
-          WHERE  d.__DeletedDatetimeUTC IS NULL AND
-                 EXISTS (
-                   SELECT 1
-                   FROM   (
-                             SELECT *, 1 AS __SourceRecordExist FROM (
-                               SELECT """ + ", ".join(__TARGET_TABLE_BK_COLUMNS) + """ FROM (SELECT """ + __EXTRACT_COLUMNS + """ FROM json.`""" + archiveLog.ArchiveFilePath + """`)
-                             )
-                          ) AS s
-                          RIGHT OUTER JOIN """ + __TARGET_DATABASE + "." + __TARGET_TABLE + """ AS t ON """ + getMatchCondition(__TARGET_TABLE_BK_COLUMNS, "Match business keys") + """
-                   WHERE  s.__SourceRecordExist IS NULL AND
-                          """ + getMatchCondition(__TARGET_TABLE_BK_COLUMNS, "Match business keys", "t", "d") + """
-                 )
-          """
-        print(setDeletedDatetimeUtcSql)
-        spark.sql(setDeletedDatetimeUtcSql)
-    else:
-        setDeletedDatetimeUtcSqlWithFilter = """
-          UPDATE """ + __TARGET_DATABASE + "." + __TARGET_TABLE + """ AS d
-          SET    d.__DeletedDatetimeUTC = '""" + str(datetimeUtcNow) + """',
-                 d.__ModifiedDatetimeUTC = '""" + str(datetimeUtcNow) + """'
-          WHERE  d.__DeletedDatetimeUTC IS NULL AND
-                 EXISTS (
-                   SELECT 1
-                   FROM   (
-                             SELECT *, 1 AS __SourceRecordExist FROM (
-                               SELECT """ + ", ".join(__TARGET_TABLE_BK_COLUMNS) + """ FROM (SELECT """ + __EXTRACT_COLUMNS + """ FROM json.`""" + archiveLog.ArchiveFilePath + """`)
-                             )
-                          ) AS s
-                          RIGHT OUTER JOIN (
-                             SELECT DISTINCT """ + getColumnsWithAlias(__TARGET_TABLE_BK_COLUMNS, "pre_t") + """
-                             FROM   """ + __TARGET_DATABASE + "." + __TARGET_TABLE + """ AS pre_t
-                                    INNER JOIN (
-                                        SELECT DISTINCT """ + __EXTRACT_COLUMNS + """ FROM json.`""" + archiveLog.ArchiveFilePath + """`
-                                    ) AS pre_s ON """ + getMatchCondition(__DELETE_FILTER_COLUMNS, "Delete filter columns", "pre_t", "pre_s") + """
-                    ) AS t ON """ + getMatchCondition(__TARGET_TABLE_BK_COLUMNS, "Match delete comparison columns") + """
-                   WHERE  s.__SourceRecordExist IS NULL AND
-                          """ + getMatchCondition(__TARGET_TABLE_BK_COLUMNS, "Match business keys", "t", "d") + """
-                 )
-          """
-        print(setDeletedDatetimeUtcSqlWithFilter)
-        spark.sql(setDeletedDatetimeUtcSqlWithFilter)
+    addMetrics("MERGE", phaseStartTime, archiveLog, __TARGET_PATH)
+    
+    for arrayColumn in __EXPLODE_ARRAYS:
+        phaseStartTime = time.perf_counter()
+        loadChildTable(dfDocument, arrayColumn, __TARGET_TABLE_BK_COLUMNS, archiveLog, datetimeUtcNow)
+        addMetrics("MERGE", phaseStartTime, archiveLog, __TARGET_PATH + "_" + arrayColumn)
+    
+    # Release materialized source
+    dfPreparedSource.unpersist()
+    if dfDocument is not None:
+        dfDocument.unpersist()
+    
+    # Commit process log of merged files so that failed run resumes from the last committed file
+    # Files with equal archive datetime are committed together as watermark cannot be placed between them
+    isWatermarkBoundary = len(processLogs) == len(dfStaticArchiveLogs) or dfStaticArchiveLogs[len(processLogs)].ArchiveDatetimeUTC != archiveLog.ArchiveDatetimeUTC
+    if __PROCESS_LOG_COMMIT_INTERVAL > 0 and len(processLogs) - committedProcessLogs >= __PROCESS_LOG_COMMIT_INTERVAL and isWatermarkBoundary:
+        phaseStartTime = time.perf_counter()
+        saveProcessLogs(processLogs[committedProcessLogs:])
+        addMetrics("PROCESS_LOG", phaseStartTime, archiveLog, __TARGET_LOG_PATH)
+        committedProcessLogs = len(processLogs)
 
 # COMMAND ----------
 
 if processLogs:
-    dfProcessLogs = spark.createDataFrame(pd.DataFrame(processLogs)) \
-                       .selectExpr("CAST(ProcessDatetime AS timestamp) AS ProcessDatetime", \
-                                   "CAST(ArchiveDatetimeUTC AS timestamp) AS ArchiveDatetimeUTC", \
-                                   "CAST(OriginalStagingFilePath AS string) AS OriginalStagingFilePath", \
-                                   "CAST(OriginalStagingFileName AS string) AS OriginalStagingFileName", \
-                                   "CAST(OriginalStagingFileSize AS long) AS OriginalStagingFileSize", \
-                                   "CAST(ArchiveFilePath AS string) AS ArchiveFilePath", \
-                                   "CAST(ArchiveFileName AS string) AS ArchiveFileName")
-    dfProcessLogs.write.format("delta") \
-                     .mode("append") \
-                     .option("mergeSchema", "true") \
-                     .save(__TARGET_LOG_PATH) 
+    if committedProcessLogs < len(processLogs):
+        phaseStartTime = time.perf_counter()
+        saveProcessLogs(processLogs[committedProcessLogs:])
+        addMetrics("PROCESS_LOG", phaseStartTime, None, __TARGET_LOG_PATH)
+  
+    if __COMPACT_LINEAGE == "TRUE":
+        print('Create lineage view: ' + __TARGET_TABLE + '_lineage')
+        createLineageView(__TARGET_TABLE, __TARGET_PATH)
+        for arrayColumn in __EXPLODE_ARRAYS:
+            createLineageView(__TARGET_TABLE + "_" + arrayColumn, __TARGET_PATH + "_" + arrayColumn)
   
     print('Optimize data delta: ' + __TARGET_PATH)
-    spark.sql('OPTIMIZE delta.`' + __TARGET_PATH + '`').display()
+    phaseStartTime = time.perf_counter()
+    optimizeTable(__TARGET_PATH, __TARGET_TABLE_BK_COLUMNS, __PARTITION_BY_COLUMNS)
+    addMetrics("OPTIMIZE", phaseStartTime, None, __TARGET_PATH, ["OPTIMIZE"])
+  
+    for arrayColumn in __EXPLODE_ARRAYS:
+        print('Optimize child data delta: ' + __TARGET_PATH + "_" + arrayColumn)
+        phaseStartTime = time.perf_counter()
+        optimizeTable(__TARGET_PATH + "_" + arrayColumn, __TARGET_TABLE_BK_COLUMNS + ["`__Index`"], None)
+        addMetrics("OPTIMIZE", phaseStartTime, None, __TARGET_PATH + "_" + arrayColumn, ["OPTIMIZE"])
   
     print('Optimize log delta: ' + __TARGET_LOG_PATH)
-    spark.sql('OPTIMIZE delta.`' + __TARGET_LOG_PATH + '`').display()
+    phaseStartTime = time.perf_counter()
+    if isMaintenanceDue(__TARGET_LOG_PATH):
+        spark.sql('OPTIMIZE delta.`' + __TARGET_LOG_PATH + '`').display()
+    addMetrics("OPTIMIZE", phaseStartTime, None, __TARGET_LOG_PATH, ["OPTIMIZE"])
+
+# COMMAND ----------
+
+if metrics:
+    addMetrics("RUN", runStartTime)
+    dfMetrics = spark.createDataFrame(pd.DataFrame(metrics)) \
+                     .selectExpr("CAST(RunId AS string) AS RunId", \
+                                 "CAST(Loader AS string) AS Loader", \
+                                 "CAST(TargetTable AS string) AS TargetTable", \
+                                 "CAST(NULLIF(TargetPath, '') AS string) AS TargetPath", \
+                                 "CAST(NULLIF(ArchiveFilePath, '') AS string) AS ArchiveFilePath", \
+                                 "CAST(Phase AS string) AS Phase", \
+                                 "CAST(EndDatetimeUTC AS timestamp) AS EndDatetimeUTC", \
+                                 "CAST(DurationSeconds AS double) AS DurationSeconds", \
+                                 "CAST(NULLIF(Operation, '') AS string) AS Operation", \
+                                 "from_json(OperationMetrics, 'map<string,string>') AS OperationMetrics", \
+                                 "CAST(get_json_object(OperationMetrics, '$.numSourceRows') AS long) AS NumSourceRows", \
+                                 "CAST(get_json_object(OperationMetrics, '$.numOutputRows') AS long) AS NumOutputRows", \
+                                 "CAST(get_json_object(OperationMetrics, '$.numTargetRowsInserted') AS long) AS NumTargetRowsInserted", \
+                                 "CAST(get_json_object(OperationMetrics, '$.numTargetRowsUpdated') AS long) AS NumTargetRowsUpdated", \
+                                 "CAST(get_json_object(OperationMetrics, '$.numTargetRowsDeleted') AS long) AS NumTargetRowsDeleted", \
+                                 "CAST(get_json_object(OperationMetrics, '$.numTargetFilesAdded') AS long) AS NumTargetFilesAdded", \
+                                 "CAST(get_json_object(OperationMetrics, '$.numTargetFilesRemoved') AS long) AS NumTargetFilesRemoved")
+    
+    # Blind appends of loaders running at the same time do not conflict
+    print('Write metrics: ' + __METRICS_PATH)
+    dfMetrics.write.format("delta") \
+             .mode("append") \
+             .option("mergeSchema", "true") \
+             .save(__METRICS_PATH)
+    dfMetrics.groupBy("Phase").sum("DurationSeconds").display()
 
 # COMMAND ----------
 
@@ -0,0 +1,511 @@
+# Databricks notebook source
+# DBTITLE 1,Information
+# MAGIC %md
+# MAGIC Read archive files once and write them to multiple targets.
+# MAGIC
+# MAGIC Each pending archive file is read and prepared once, cached and written to all configured targets (sinks) that have not yet processed the file.
+# MAGIC Every sink keeps its own process log and watermark, so a sink can be added later or fail without affecting the others.
+# MAGIC
+# MAGIC Supported sink types:
+# MAGIC - DATABRICKS_SCD1: Merge into databricks delta table with slowly changing dimension type 1 logic of FromArchiveToDatabricks Scd1 loaders. TARGET_DATABASE, TARGET_TABLE, TARGET_TABLE_BK_COLUMNS and TARGET_PATH (datahub container) are required. Optional EXCLUDE_COLUMNS, PARTITION_BY_COLUMNS, HASH_DIFF_ALGORITHM (SHA256, SHA256_BINARY or XXHASH64) and COMPACT_LINEAGE work like loader parameters
+# MAGIC - AZURE_SQL: Stage into Azure SQL DB table. TABLE_NAME and TEMP_PATH (synapse container) are required. Optional JDBC_CONNECTION_STRING is name of the secret
+# MAGIC - SYNAPSE: Stage into Azure Synapse Analytics table. TABLE_NAME and TEMP_PATH (synapse container) are required. Optional DISTRIBUTION and MAX_STRING_LENGTH
+# MAGIC - PUBLISH: Append parquet files into publish folder. TARGET_PATH (datahub container) is required
+# MAGIC
+# MAGIC LOG_PATH of each sink is required. Log is stored to datahub container for DATABRICKS_SCD1 and PUBLISH sinks and to synapse container for AZURE_SQL and SYNAPSE sinks like in single target notebooks.
+# MAGIC
+# MAGIC Required additional libraries:
+# MAGIC - None
+# MAGIC
+# MAGIC Example call:
+# MAGIC ```
+# MAGIC returnFlag = dbutils.notebook.run(
+# MAGIC   path = "/DataLake/__Library/FromArchiveToMultipleTargets/FromArchiveToMultipleTargets",
+# MAGIC   timeout_seconds = 0,
+# MAGIC   arguments = {
+# MAGIC     "ARCHIVE_PATH": "/archive/adventureworkslt/customer",
+# MAGIC     "FILE_FORMAT": "PARQUET",
+# MAGIC     "EXTRACT_COLUMNS": "*",
+# MAGIC     "SINKS": """[
+# MAGIC       {
+# MAGIC         "TYPE": "DATABRICKS_SCD1",
+# MAGIC         "TARGET_DATABASE": "adventureworkslt",
+# MAGIC         "TARGET_TABLE": "customer",
+# MAGIC         "TARGET_TABLE_BK_COLUMNS": "CustomerID",
+# MAGIC         "TARGET_PATH": "/analytics/datahub/adventureworkslt/customer/data",
+# MAGIC         "LOG_PATH": "/analytics/datahub/adventureworkslt/customer/log"
+# MAGIC       },
+# MAGIC       {
+# MAGIC         "TYPE": "SYNAPSE",
+# MAGIC         "TABLE_NAME": "stg.X_adventureworkslt_customer",
+# MAGIC         "TEMP_PATH": "/analytics/datawarehouse/adventureworkslt/customer/temp",
+# MAGIC         "LOG_PATH": "/analytics/datawarehouse/adventureworkslt/customer/log"
+# MAGIC       },
+# MAGIC       {
+# MAGIC         "TYPE": "PUBLISH",
+# MAGIC         "TARGET_PATH": "/publish/adventureworkslt/customer",
+# MAGIC         "LOG_PATH": "/publish/adventureworkslt/customer/log"
+# MAGIC       }
+# MAGIC     ]"""
+# MAGIC   }
+# MAGIC )
+# MAGIC ```
+
+# COMMAND ----------
+
+# Parameters
+try:
+    # Archive path e.g. archive/adventureworkslt/address/
+    __ARCHIVE_PATH = dbutils.widgets.get("ARCHIVE_PATH")
+
+    # Optional: Archive log path e.g. archive/adventureworkslt/customer/log/
+    __ARCHIVE_LOG_PATH = __ARCHIVE_PATH + "/log"
+    try:
+        __ARCHIVE_LOG_PATH = dbutils.widgets.get("ARCHIVE_LOG_PATH")
+    except:
+        print("Using default archive log path: " + __ARCHIVE_LOG_PATH)
+
+    # Sinks as JSON array. See supported sink types above
+    __SINKS = dbutils.widgets.get("SINKS")
+
+    # Columns to extract e.g. * or AddressID, AddressLine1, AddressLine2, City, StateProvince, CountryRegion, PostalCode, rowguid, ModifiedDate
+    __EXTRACT_COLUMNS = dbutils.widgets.get("EXTRACT_COLUMNS")
+
+    # Optional: Archive file format. Use "PARQUET" or "CSV"
+    __FILE_FORMAT = "PARQUET"
+    try:
+        __FILE_FORMAT = dbutils.widgets.get("FILE_FORMAT")
+    except:
+        print("Using default file format: " + __FILE_FORMAT)
+
+    # Optional: Column delimiter in the source csv file e.g. ;
+    __DELIMITER = ";"
+    try:
+        __DELIMITER = dbutils.widgets.get("DELIMITER")
+    except:
+        print("Using default CSV delimiter: " + __DELIMITER)
+
+    # Optional: Encoding of the source csv file e.g. UTF-8
+    __ENCODING = "UTF-8"
+    try:
+        __ENCODING = dbutils.widgets.get("ENCODING")
+    except:
+        print("Using default CSV encoding: " + __ENCODING)
+
+    # Include previous. Use "True" or "False"
+    # True = ArchiveDatetimeUTC >= lastArchiveDatetimeUTC
+    # False = ArchiveDatetimeUTC > lastArchiveDatetimeUTC
+    __INCLUDE_PREVIOUS = "False"
+    try:
+        __INCLUDE_PREVIOUS = dbutils.widgets.get("INCLUDE_PREVIOUS")
+    except:
+        print("Using default include previous: " + __INCLUDE_PREVIOUS)
+
+except:
+    raise Exception("Required parameter(s) missing")
+
+# COMMAND ----------
+
+# Import
+import sys
+import json
+import uuid
+from delta.tables import *
+from pyspark import StorageLevel
+from pyspark.sql.functions import lit, col, sha2, unhex, concat_ws, xxhash64
+from pyspark.sql.utils import AnalysisException
+from datetime import datetime
+import pandas as pd
+
+# Enable automatic schema evolution
+spark.sql("SET spark.databricks.delta.schema.autoMerge.enabled = true")
+
+# Configuration
+__SECRET_SCOPE = "KeyVault"
+__SECRET_NAME_DATA_LAKE_APP_CLIENT_ID = "App-databricks-id"
+__SECRET_NAME_DATA_LAKE_APP_CLIENT_SECRET = "App-databricks-secret"
+__SECRET_NAME_DATA_LAKE_APP_CLIENT_TENANT_ID = "App-databricks-tenant-id"
+__SECRET_NAME_SQL_JDBC_CONNECTION_STRING = "SQL-JDBC-connection-string"
+__SECRET_NAME_SYNAPSE_JDBC_CONNECTION_STRING = "Synapse-JDBC-connection-string"
+__DATA_LAKE_NAME = dbutils.secrets.get(scope = __SECRET_SCOPE, key = "Storage-Name")
+
+# Hash diff data type per algorithm as in FromArchiveToDatabricks loaders
+__HASH_DIFF_DATA_TYPES = { "SHA256": "string", "SHA256_BINARY": "binary", "XXHASH64": "bigint" }
+
+# Lineage columns added to source of all sinks. Not part of hash diff
+__SOURCE_LINEAGE_COLUMNS = ['__ArchiveDatetimeUTC', '__OriginalStagingFileName']
+
+__ARCHIVE_PATH = "abfss://archive@" + __DATA_LAKE_NAME + ".dfs.core.windows.net/" + __ARCHIVE_PATH
+__ARCHIVE_LOG_PATH = "abfss://archive@" + __DATA_LAKE_NAME + ".dfs.core.windows.net/" + __ARCHIVE_LOG_PATH
+
+# In Spark 3.1, loading and saving of timestamps from/to parquet files fails if the timestamps are before 1900-01-01 00:00:00Z, and loaded (saved) as the INT96 type.
+# In Spark 3.0, the actions don’t fail but might lead to shifting of the input timestamps due to rebasing from/to Julian to/from Proleptic Gregorian calendar.
+# To restore the behavior before Spark 3.1, you can set spark.sql.parquet.int96RebaseModeInRead or/and spark.sql.legacy.parquet.int96RebaseModeInWrite to LEGACY.
+spark.conf.set("spark.sql.parquet.int96RebaseModeInWrite", "LEGACY")
+spark.conf.set("spark.sql.parquet.int96RebaseModeInRead", "LEGACY")
+
+# Configure the write semantics for Azure Synapse connector to use the COPY statement
+spark.conf.set("spark.databricks.sqldw.writeSemantics", "copy")
+
+# Data lake authentication
+spark.conf.set("fs.azure.account.auth.type." + __DATA_LAKE_NAME + ".dfs.core.windows.net", "OAuth")
+spark.conf.set("fs.azure.account.oauth.provider.type." + __DATA_LAKE_NAME + ".dfs.core.windows.net", "org.apache.hadoop.fs.azurebfs.oauth2.ClientCredsTokenProvider")
+spark.conf.set("fs.azure.account.oauth2.client.id." + __DATA_LAKE_NAME + ".dfs.core.windows.net", dbutils.secrets.get(scope = __SECRET_SCOPE, key = __SECRET_NAME_DATA_LAKE_APP_CLIENT_ID))
+spark.conf.set("fs.azure.account.oauth2.client.secret." + __DATA_LAKE_NAME + ".dfs.core.windows.net", dbutils.secrets.get(scope = __SECRET_SCOPE, key = __SECRET_NAME_DATA_LAKE_APP_CLIENT_SECRET))
+spark.conf.set("fs.azure.account.oauth2.client.endpoint." + __DATA_LAKE_NAME + ".dfs.core.windows.net", "https://login.microsoftonline.com/" + dbutils.secrets.get(scope = __SECRET_SCOPE, key = __SECRET_NAME_DATA_LAKE_APP_CLIENT_TENANT_ID) + "/oauth2/token")
+
+# COMMAND ----------
+
+def getDataLakePath(container, path):
+    return "abfss://" + container + "@" + __DATA_LAKE_NAME + ".dfs.core.windows.net/" + path
+
+# COMMAND ----------
+
+def getSinks(sinksJson):
+    # Sink configuration with resolved paths, process log and watermark of the sink
+    requiredKeys = {
+        "DATABRICKS_SCD1": ["TARGET_DATABASE", "TARGET_TABLE", "TARGET_TABLE_BK_COLUMNS", "TARGET_PATH"],
+        "AZURE_SQL": ["TABLE_NAME", "TEMP_PATH"],
+        "SYNAPSE": ["TABLE_NAME", "TEMP_PATH"],
+        "PUBLISH": ["TARGET_PATH"]
+    }
+
+    sinks = []
+    for sink in json.loads(sinksJson):
+        sink["TYPE"] = sink.get("TYPE", "").strip().upper()
+        if sink["TYPE"] not in requiredKeys:
+            raise Exception("Unsupported sink type: " + sink["TYPE"])
+        missingKeys = [key for key in requiredKeys[sink["TYPE"]] + ["LOG_PATH"] if key not in sink]
+        if missingKeys:
+            raise Exception(sink["TYPE"] + " sink requires: " + ", ".join(missingKeys))
+
+        container = "synapse" if sink["TYPE"] in ["AZURE_SQL", "SYNAPSE"] else "datahub"
+        sink["LOG_PATH"] = getDataLakePath(container, sink["LOG_PATH"] + "/processDatetime/")
+        if "TARGET_PATH" in sink:
+            sink["TARGET_PATH"] = getDataLakePath(container, sink["TARGET_PATH"])
+        if "TEMP_PATH" in sink:
+            sink["TEMP_PATH"] = getDataLakePath(container, sink["TEMP_PATH"] + "/" + str(uuid.uuid4()))
+        if "TARGET_TABLE_BK_COLUMNS" in sink:
+            sink["TARGET_TABLE_BK_COLUMNS"] = ["`" + x.strip() + "`" for x in sink["TARGET_TABLE_BK_COLUMNS"].replace('[', '').replace(']', '').split(',')]
+        if "TABLE_NAME" in sink:
+            sink["TABLE_NAME"] = sink["TABLE_NAME"].replace('[', '').replace(']', '')
+        if sink["TYPE"] == "DATABRICKS_SCD1":
+            prepareDatabricksScd1Sink(sink)
+
+        sink["NAME"] = sink["TYPE"] + ": " + sink.get("TABLE_NAME", sink.get("TARGET_TABLE", sink.get("TARGET_PATH", "")))
+        sink["LAST_ARCHIVE_DATETIME_UTC"] = getLastArchiveDatetimeUTC(sink["LOG_PATH"])
+        sink["PROCESS_LOGS"] = []
+        sink["STAGED"] = False
+        sink["FAILED"] = False
+        sinks.append(sink)
+
+    return sinks
+
+# COMMAND ----------
+
+def prepareDatabricksScd1Sink(sink):
+    # Optional settings of Scd1 loaders
+    sink["EXCLUDE_COLUMNS"] = [x.strip() for x in sink.get("EXCLUDE_COLUMNS", "").replace('[', '').replace(']', '').split(',') if x.strip() != ""]
+    sink["PARTITION_BY_COLUMNS"] = ["`" + x.strip() + "`" for x in sink.get("PARTITION_BY_COLUMNS", "").replace('[', '').replace(']', '').split(',') if x.strip() != ""] or None
+    sink["COMPACT_LINEAGE"] = str(sink.get("COMPACT_LINEAGE", "False")).strip().upper()
+
+    sink["HASH_DIFF_ALGORITHM"] = sink.get("HASH_DIFF_ALGORITHM", "SHA256").strip().upper()
+    if sink["HASH_DIFF_ALGORITHM"] not in __HASH_DIFF_DATA_TYPES:
+        raise Exception("Unsupported hash diff algorithm: " + sink["HASH_DIFF_ALGORITHM"])
+
+    # Hash diff data type cannot be changed on existing target table
+    if DeltaTable.isDeltaTable(spark, sink["TARGET_PATH"]):
+        targetHashDiffDataType = DeltaTable.forPath(spark, sink["TARGET_PATH"]).toDF().schema["__HashDiff"].dataType.simpleString()
+        if targetHashDiffDataType != __HASH_DIFF_DATA_TYPES[sink["HASH_DIFF_ALGORITHM"]]:
+            raise Exception("Target __HashDiff data type '" + targetHashDiffDataType + "' does not match hash diff algorithm " + sink["HASH_DIFF_ALGORITHM"] + " (" + sink["TARGET_PATH"] + ")")
+
+# COMMAND ----------
+
+def getLastArchiveDatetimeUTC(logPath):
+    # Watermark of sink
+    try:
+        # Try to read existing log
+        lastArchiveDatetimeUTC = spark.sql("SELECT MAX(ArchiveDatetimeUTC) AS ArchiveDatetimeUTC FROM delta.`" + logPath + "`").collect()[0][0]
+        print("Using existing log with time: " + str(lastArchiveDatetimeUTC) + " (" + logPath + ")")
+    except AnalysisException as ex:
+        # Initiliaze delta as it did not exist
+        dfProcessDatetimes = spark.sql("SELECT CAST(date_sub(current_timestamp(), 5) AS timestamp) AS ArchiveDatetimeUTC")
+        dfProcessDatetimes.write.format("delta").mode("append").option("mergeSchema", "true").save(logPath)
+        lastArchiveDatetimeUTC = spark.sql("SELECT MAX(ArchiveDatetimeUTC) AS ArchiveDatetimeUTC FROM delta.`" + logPath + "`").collect()[0][0]
+        print("Initiliazed log with time: " + str(lastArchiveDatetimeUTC) + " (" + logPath + ")")
+
+    return lastArchiveDatetimeUTC
+
+# COMMAND ----------
+
+def isPendingArchiveFile(sink, archiveLog):
+    if sink["FAILED"]:
+        return False
+    if __INCLUDE_PREVIOUS == "True":
+        return archiveLog.ArchiveDatetimeUTC >= sink["LAST_ARCHIVE_DATETIME_UTC"]
+    return archiveLog.ArchiveDatetimeUTC > sink["LAST_ARCHIVE_DATETIME_UTC"]
+
+# COMMAND ----------
+
+def getSource(archiveLog):
+    # Archive file is read and prepared once for all sinks
+    if __FILE_FORMAT == "CSV":
+        dfArchive = spark.read.option("header", True).option("encoding", __ENCODING).option("delimiter", __DELIMITER).csv(archiveLog.ArchiveFilePath)
+    else:
+        dfArchive = spark.read.parquet(archiveLog.ArchiveFilePath)
+
+    dfArchiveViewName = "tmp_" + str(uuid.uuid4()).replace('-', '_')
+    dfArchive.createOrReplaceTempView(dfArchiveViewName)
+    dfSource = spark.sql("SELECT " + __EXTRACT_COLUMNS + " FROM `" + dfArchiveViewName + "`")
+
+    # Remove empty spaces from column names as those are not supported by all sinks
+    dfSource = dfSource.toDF(*[c.replace(" ", "_") for c in dfSource.columns])
+
+    return dfSource.withColumn('__ArchiveDatetimeUTC', lit(archiveLog.ArchiveDatetimeUTC)) \
+                   .withColumn('__OriginalStagingFileName', lit(archiveLog.OriginalStagingFileName))
+
+# COMMAND ----------
+
+def getHashDiffColumn(columns, algorithm):
+    if algorithm == "XXHASH64":
+        # Typed hash over columns in name order. Null marker per column keeps NULL, empty string and shifted values apart
+        hashColumns = []
+        for columnName in sorted(columns, key = lambda x: x.lower()):
+            hashColumns.append(col("`" + columnName + "`"))
+            hashColumns.append(col("`" + columnName + "`").isNull())
+        return xxhash64(*hashColumns)
+
+    hashDiff = sha2(concat_ws("||", *columns), 256)
+    if algorithm == "SHA256_BINARY":
+        # Same digest as SHA256, so existing hex values convert with unhex
+        return unhex(hashDiff)
+
+    return hashDiff
+
+# COMMAND ----------
+
+def getLineageColumns(sink, archiveLog):
+    # Compact lineage stores id of archive file instead of path strings repeated on every row
+    if sink["COMPACT_LINEAGE"] == "TRUE":
+        return { '__ArchiveFileId': xxhash64(lit(archiveLog.ArchiveFilePath)) }
+
+    return {
+        '__ArchiveFilePath': lit(archiveLog.ArchiveFilePath),
+        '__OriginalStagingFileName': lit(archiveLog.OriginalStagingFileName)
+    }
+
+# COMMAND ----------
+
+def createLineageView(sink):
+    # Process log is lineage dimension of archive files. View is re-created on each run as its columns are fixed at creation
+    spark.sql("""
+      CREATE OR REPLACE VIEW `""" + sink["TARGET_DATABASE"] + """`.`""" + sink["TARGET_TABLE"] + """_lineage`
+      AS
+      SELECT t.*, l.ArchiveFilePath AS `__ArchiveFilePath`, l.OriginalStagingFileName AS `__OriginalStagingFileName`
+      FROM delta.`""" + sink["TARGET_PATH"] + """` t
+      LEFT JOIN (
+        SELECT DISTINCT COALESCE(ArchiveFileId, xxhash64(ArchiveFilePath)) AS ArchiveFileId, ArchiveFilePath, OriginalStagingFileName
+        FROM delta.`""" + sink["LOG_PATH"] + """`
+        WHERE ArchiveFilePath IS NOT NULL
+      ) l ON t.`__ArchiveFileId` = l.ArchiveFileId
+     """)
+
+# COMMAND ----------
+
+def getPartitionCondition(dfSource, columns):
+    # Partition values in file as merge predicate so that only those partitions of target are read
+    if columns is None:
+        return ""
+
+    condition = ""
+    for partitionColumn in columns:
+        partitionValues = list(dfSource.select(partitionColumn).distinct().toPandas()[partitionColumn.strip('`')])
+        sPartitionValues = ",".join(f"'{pv}'" for pv in partitionValues if not str(pv).isnumeric())
+        if sPartitionValues == "":
+            sPartitionValues = ",".join(str(pv) for pv in partitionValues)
+        condition = condition + f" AND t.{partitionColumn} IN ({sPartitionValues})"
+
+    print("Partition optimization:" + condition)
+    return condition
+
+# COMMAND ----------
+
+def writeDatabricksScd1(sink, dfSource, archiveLog):
+    # Same hash diff, modified datetime and lineage columns as in FromArchiveToDatabricks Scd1 loaders
+    dfTarget = dfSource.drop(*__SOURCE_LINEAGE_COLUMNS)
+    for columnToExclude in sink["EXCLUDE_COLUMNS"]:
+        dfTarget = dfTarget.drop(col("`" + columnToExclude + "`"))
+
+    dfTarget = dfTarget.withColumn("__HashDiff", getHashDiffColumn(dfTarget.columns, sink["HASH_DIFF_ALGORITHM"])) \
+                       .withColumn('__ModifiedDatetimeUTC', lit(datetime.utcnow())) \
+                       .withColumn('__ArchiveDatetimeUTC', lit(archiveLog.ArchiveDatetimeUTC)) \
+                       .withColumns(getLineageColumns(sink, archiveLog))
+
+    if not DeltaTable.isDeltaTable(spark, sink["TARGET_PATH"]):
+        print("Initial table creation: " + sink["TARGET_DATABASE"] + "." + sink["TARGET_TABLE"])
+        spark.sql("CREATE DATABASE IF NOT EXISTS " + sink["TARGET_DATABASE"])
+        dfWriter = dfTarget.write.format("delta").option("path", sink["TARGET_PATH"])
+        if sink["PARTITION_BY_COLUMNS"] is not None:
+            dfWriter = dfWriter.partitionBy(sink["PARTITION_BY_COLUMNS"])
+        dfWriter.saveAsTable(sink["TARGET_DATABASE"] + "." + sink["TARGET_TABLE"])
+        return
+
+    matchCondition = " AND ".join(["s." + c + " <=> t." + c for c in sink["TARGET_TABLE_BK_COLUMNS"]])
+    DeltaTable.forPath(spark, sink["TARGET_PATH"]).alias("t").merge(
+        dfTarget.alias("s"),
+        matchCondition + getPartitionCondition(dfTarget, sink["PARTITION_BY_COLUMNS"])
+    ).whenMatchedUpdateAll(
+      condition = "s.`__HashDiff` != t.`__HashDiff`"
+    ).whenNotMatchedInsertAll(
+    ).execute()
+
+# COMMAND ----------
+
+def writeSink(sink, dfSource, archiveLog):
+    if sink["TYPE"] == "DATABRICKS_SCD1":
+        writeDatabricksScd1(sink, dfSource, archiveLog)
+    elif sink["TYPE"] in ["AZURE_SQL", "SYNAPSE"]:
+        # Staged files are written to database table once after all archive files
+        dfSource.write.mode("append").parquet(sink["TEMP_PATH"])
+        sink["STAGED"] = True
+    elif sink["TYPE"] == "PUBLISH":
+        dfSource.write.format("parquet").mode("append").save(sink["TARGET_PATH"])
+
+# COMMAND ----------
+
+def writeStagedSink(sink):
+    dfAnalytics = spark.read.option("mergeSchema", "true").parquet(sink["TEMP_PATH"])
+
+    if sink["TYPE"] == "AZURE_SQL":
+        sqlJdbc = dbutils.secrets.get(scope = __SECRET_SCOPE, key = sink.get("JDBC_CONNECTION_STRING", __SECRET_NAME_SQL_JDBC_CONNECTION_STRING))
+        dfAnalytics.write.mode("overwrite").jdbc(url=sqlJdbc, table=sink["TABLE_NAME"])
+    else:
+        synapseJdbc = dbutils.secrets.get(scope = __SECRET_SCOPE, key = __SECRET_NAME_SYNAPSE_JDBC_CONNECTION_STRING)
+        distribution = sink.get("DISTRIBUTION", "ROUND_ROBIN")
+        maxStringLength = str(sink.get("MAX_STRING_LENGTH", 250))
+        dfWriter = dfAnalytics.write \
+                              .format("com.databricks.spark.sqldw") \
+                              .option("url", synapseJdbc) \
+                              .option("forwardSparkAzureStorageCredentials", "false") \
+                              .option("useAzureMSI", "true") \
+                              .option("tableOptions", "DISTRIBUTION = " + distribution + ", HEAP") \
+                              .option("dbTable", sink["TABLE_NAME"]) \
+                              .option("tempDir", "abfss://databricks@" + __DATA_LAKE_NAME + ".dfs.core.windows.net/temp")
+        if maxStringLength.upper() != "MAX":
+            dfWriter.mode("overwrite").option("maxStrLength", maxStringLength).save()
+        else:
+            # Table is created with nvarchar(max) columns before load
+            spark.createDataFrame([], dfAnalytics.schema).write \
+                 .option("createTableOptions", "WITH(DISTRIBUTION = " + distribution + ", HEAP)") \
+                 .option("batchsize", 1) \
+                 .jdbc(url=synapseJdbc, table=sink["TABLE_NAME"], mode="overwrite")
+            dfWriter.mode("append").save()
+
+    dbutils.fs.rm(sink["TEMP_PATH"], True)
+
+# COMMAND ----------
+
+__FILE_FORMAT = __FILE_FORMAT.strip().upper()
+if __FILE_FORMAT not in ["PARQUET", "CSV"]:
+    raise Exception("Unsupported file format: " + __FILE_FORMAT)
+
+__EXTRACT_COLUMNS = __EXTRACT_COLUMNS.replace('[','`').replace(']','`')
+
+sinks = getSinks(__SINKS)
+if not sinks:
+    raise Exception("No sinks configured")
+
+# Archive log is read once from the earliest watermark of sinks
+lastArchiveDatetimeUTC = min(sink["LAST_ARCHIVE_DATETIME_UTC"] for sink in sinks)
+try:
+    dfArchiveLogs = spark.sql(" \
+      SELECT * \
+      FROM   delta.`" + __ARCHIVE_LOG_PATH + "` \
+      WHERE  ArchiveDatetimeUTC " + (__INCLUDE_PREVIOUS == "True" and ">=" or ">") + " CAST('" + str(lastArchiveDatetimeUTC) + "' AS timestamp) AND `IsPurged` = 0 AND `IsIgnorable` = 0 \
+      ORDER BY ArchiveDatetimeUTC ASC, OriginalModificationTime ASC \
+    ")
+except:
+    # Failsafe without OriginalModificationTime that was included later on to archive log
+    dfArchiveLogs = spark.sql(" \
+      SELECT * \
+      FROM   delta.`" + __ARCHIVE_LOG_PATH + "` \
+      WHERE  ArchiveDatetimeUTC " + (__INCLUDE_PREVIOUS == "True" and ">=" or ">") + " CAST('" + str(lastArchiveDatetimeUTC) + "' AS timestamp) AND `IsPurged` = 0 AND `IsIgnorable` = 0 \
+      ORDER BY ArchiveDatetimeUTC ASC \
+    ")
+
+# COMMAND ----------
+
+dfStaticArchiveLogs = dfArchiveLogs.collect()
+for archiveLog in dfStaticArchiveLogs:
+    pendingSinks = [sink for sink in sinks if isPendingArchiveFile(sink, archiveLog)]
+    if not pendingSinks:
+        continue
+
+    print("Processing file: " + archiveLog.ArchiveFilePath + " (" + str(len(pendingSinks)) + " sinks)")
+
+    # Materialize prepared source once per file. All pending sinks reuse it
+    dfSource = getSource(archiveLog).persist(StorageLevel.MEMORY_AND_DISK)
+
+    for sink in pendingSinks:
+        try:
+            writeSink(sink, dfSource, archiveLog)
+        except Exception as e:
+            # Sink stops at failed file. Its watermark stays before the file and later runs continue from it
+            print("Could not process file to " + sink["NAME"] + ": " + str(e))
+            sink["FAILED"] = True
+            continue
+
+        sink["PROCESS_LOGS"].append({
+          'ProcessDatetime': datetime.utcnow(),
+          'ArchiveDatetimeUTC': archiveLog.ArchiveDatetimeUTC,
+          'OriginalStagingFilePath': archiveLog.OriginalStagingFilePath,
+          'OriginalStagingFileName': archiveLog.OriginalStagingFileName,
+          'OriginalStagingFileSize': archiveLog.OriginalStagingFileSize,
+          'ArchiveFilePath': archiveLog.ArchiveFilePath,
+          'ArchiveFileName': archiveLog.ArchiveFileName
+        })
+
+    # Release materialized source
+    dfSource.unpersist()
+
+# COMMAND ----------
+
+for sink in sinks:
+    if sink["STAGED"]:
+        try:
+            print("Write staged files to " + sink["NAME"])
+            writeStagedSink(sink)
+        except Exception as e:
+            # Process log is not written so that staged archive files are processed again on next run
+            print("Could not write staged files to " + sink["NAME"] + ": " + str(e))
+            sink["FAILED"] = True
+            sink["PROCESS_LOGS"] = []
+
+    if sink["PROCESS_LOGS"]:
+        dfProcessLogs = spark.createDataFrame(pd.DataFrame(sink["PROCESS_LOGS"])) \
+                           .selectExpr("CAST(ProcessDatetime AS timestamp) AS ProcessDatetime", \
+                                       "CAST(ArchiveDatetimeUTC AS timestamp) AS ArchiveDatetimeUTC", \
+                                       "CAST(OriginalStagingFilePath AS string) AS OriginalStagingFilePath", \
+                                       "CAST(OriginalStagingFileName AS string) AS OriginalStagingFileName", \
+                                       "CAST(OriginalStagingFileSize AS long) AS OriginalStagingFileSize", \
+                                       "CAST(ArchiveFilePath AS string) AS ArchiveFilePath", \
+                                       "CAST(ArchiveFileName AS string) AS ArchiveFileName", \
+                                       "xxhash64(CAST(ArchiveFilePath AS string)) AS ArchiveFileId")
+        dfProcessLogs.write.format("delta") \
+                         .mode("append") \
+                         .option("mergeSchema", "true") \
+                         .save(sink["LOG_PATH"])
+
+        if sink["TYPE"] == "DATABRICKS_SCD1" and sink["COMPACT_LINEAGE"] == "TRUE":
+            print('Create lineage view: ' + sink["TARGET_TABLE"] + '_lineage')
+            createLineageView(sink)
+        print(sink["NAME"] + ": " + str(len(sink["PROCESS_LOGS"])) + " files processed")
+
+failedSinks = [sink["NAME"] for sink in sinks if sink["FAILED"]]
+if failedSinks:
+    raise Exception("Sink(s) failed: " + ", ".join(failedSinks))
+
+# COMMAND ----------
+
+# Return success
+dbutils.notebook.exit(True)
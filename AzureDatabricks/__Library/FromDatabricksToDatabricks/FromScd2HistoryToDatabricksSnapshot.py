@@ -0,0 +1,214 @@
+# Databricks notebook source
+# DBTITLE 1,Information
+# MAGIC %md
+# MAGIC Materialize daily or monthly point-in-time snapshots of slowly changing dimension type 2 history table (FromParquetArchiveToDatabricksScd2) into databricks database table.
+# MAGIC
+# MAGIC Each snapshot holds the versions that are valid at the end of snapshot date (__StartDatetimeUTC < end of date <= __EndDatetimeUTC) and is stored as own __SnapshotDate partition, so that "as of" query reads one partition instead of all history.
+# MAGIC Snapshots are built incrementally: the last snapshot (built while its period was still open) and newer snapshots up to the current date are rebuilt on every run.
+# MAGIC
+# MAGIC Required additional libraries:
+# MAGIC - None
+# MAGIC
+# MAGIC Example call:
+# MAGIC ```
+# MAGIC returnFlag = dbutils.notebook.run(
+# MAGIC   path = "/DataLake/__Library/FromDatabricksToDatabricks/FromScd2HistoryToDatabricksSnapshot",
+# MAGIC   timeout_seconds = 0,
+# MAGIC   arguments = {
+# MAGIC     "SOURCE_DATABASE": "adventureworkslt",
+# MAGIC     "SOURCE_TABLE": "customer_history",
+# MAGIC     "TARGET_DATABASE": "adventureworkslt",
+# MAGIC     "TARGET_TABLE": "customer_snapshot",
+# MAGIC     "TARGET_PATH": "/analytics/datahub/adventureworkslt/customer_snapshot/data",
+# MAGIC     "SNAPSHOT_GRAIN": "DAY"
+# MAGIC   }
+# MAGIC )
+# MAGIC ```
+# MAGIC
+# MAGIC Example query:
+# MAGIC ```
+# MAGIC SELECT * FROM adventureworkslt.customer_snapshot WHERE __SnapshotDate = '2024-05-31'
+# MAGIC ```
+
+# COMMAND ----------
+
+# Parameters
+try:
+    # Source database e.g. adventureworkslt
+    __SOURCE_DATABASE = dbutils.widgets.get("SOURCE_DATABASE")
+
+    # Source SCD2 history table e.g. customer_history
+    __SOURCE_TABLE = dbutils.widgets.get("SOURCE_TABLE")
+
+    # Target database e.g. adventureworkslt
+    __TARGET_DATABASE = dbutils.widgets.get("TARGET_DATABASE")
+
+    # Target snapshot table e.g. customer_snapshot
+    __TARGET_TABLE = dbutils.widgets.get("TARGET_TABLE")
+
+    # Target path e.g. analytics/datahub/adventureworkslt/customer_snapshot/data
+    __TARGET_PATH = dbutils.widgets.get("TARGET_PATH")
+
+    # Optional: Snapshot grain. Use "DAY" or "MONTH"
+    # DAY = snapshot at the end of every day, MONTH = snapshot at the end of every month (__SnapshotDate is the last day of month)
+    __SNAPSHOT_GRAIN = "DAY"
+    try:
+        __SNAPSHOT_GRAIN = dbutils.widgets.get("SNAPSHOT_GRAIN")
+    except:
+        print("Using default snapshot grain: " + __SNAPSHOT_GRAIN)
+
+    # Optional: Date of the first snapshot on initial load or full refresh e.g. 2024-01-01. Empty = date of the first version in history
+    __SNAPSHOT_START_DATE = ""
+    try:
+        __SNAPSHOT_START_DATE = dbutils.widgets.get("SNAPSHOT_START_DATE")
+    except:
+        print("Using default snapshot start date: first version in history")
+
+    # Optional: Rebuild all snapshots since SNAPSHOT_START_DATE e.g. after history table was reloaded with backfill. Use "True" or "False"
+    __FULL_REFRESH = "False"
+    try:
+        __FULL_REFRESH = dbutils.widgets.get("FULL_REFRESH")
+    except:
+        print("Using default full refresh: " + __FULL_REFRESH)
+
+    # Optional: Z-order columns of snapshot partitions e.g. CustomerID. Empty = no Z-order
+    __ZORDER_BY_COLUMNS = ""
+    try:
+        __ZORDER_BY_COLUMNS = dbutils.widgets.get("ZORDER_BY_COLUMNS")
+    except:
+        print("No Z-order columns")
+
+except:
+    raise Exception("Required parameter(s) missing")
+
+# COMMAND ----------
+
+# Import
+import sys
+import calendar
+from delta.tables import *
+from pyspark.sql.functions import col, expr, broadcast
+from datetime import datetime, date, timedelta
+import pandas as pd
+
+# Configuration
+__SECRET_SCOPE = "KeyVault"
+__SECRET_NAME_DATA_LAKE_APP_CLIENT_ID = "App-databricks-id"
+__SECRET_NAME_DATA_LAKE_APP_CLIENT_SECRET = "App-databricks-secret"
+__SECRET_NAME_DATA_LAKE_APP_CLIENT_TENANT_ID = "App-databricks-tenant-id"
+__DATA_LAKE_NAME = dbutils.secrets.get(scope = __SECRET_SCOPE, key = "Storage-Name")
+
+__TARGET_PATH = "abfss://datahub@" + __DATA_LAKE_NAME + ".dfs.core.windows.net/" + __TARGET_PATH
+
+# Data lake authentication
+spark.conf.set("fs.azure.account.auth.type." + __DATA_LAKE_NAME + ".dfs.core.windows.net", "OAuth")
+spark.conf.set("fs.azure.account.oauth.provider.type." + __DATA_LAKE_NAME + ".dfs.core.windows.net", "org.apache.hadoop.fs.azurebfs.oauth2.ClientCredsTokenProvider")
+spark.conf.set("fs.azure.account.oauth2.client.id." + __DATA_LAKE_NAME + ".dfs.core.windows.net", dbutils.secrets.get(scope = __SECRET_SCOPE, key = __SECRET_NAME_DATA_LAKE_APP_CLIENT_ID))
+spark.conf.set("fs.azure.account.oauth2.client.secret." + __DATA_LAKE_NAME + ".dfs.core.windows.net", dbutils.secrets.get(scope = __SECRET_SCOPE, key = __SECRET_NAME_DATA_LAKE_APP_CLIENT_SECRET))
+spark.conf.set("fs.azure.account.oauth2.client.endpoint." + __DATA_LAKE_NAME + ".dfs.core.windows.net", "https://login.microsoftonline.com/" + dbutils.secrets.get(scope = __SECRET_SCOPE, key = __SECRET_NAME_DATA_LAKE_APP_CLIENT_TENANT_ID) + "/oauth2/token")
+
+# COMMAND ----------
+
+def getSnapshotDate(day):
+    # Snapshot date is the last day of snapshot period
+    if __SNAPSHOT_GRAIN == "MONTH":
+        return date(day.year, day.month, calendar.monthrange(day.year, day.month)[1])
+
+    return day
+
+# COMMAND ----------
+
+def getSnapshotDates(firstSnapshotDate, lastSnapshotDate):
+    snapshotDates = []
+    snapshotDate = firstSnapshotDate
+    while snapshotDate <= lastSnapshotDate:
+        snapshotDates.append(snapshotDate)
+        snapshotDate = getSnapshotDate(snapshotDate + timedelta(days = 1))
+
+    return snapshotDates
+
+# COMMAND ----------
+
+__SNAPSHOT_GRAIN = __SNAPSHOT_GRAIN.strip().upper()
+if __SNAPSHOT_GRAIN not in ["DAY", "MONTH"]:
+    raise Exception("Unsupported snapshot grain: " + __SNAPSHOT_GRAIN)
+print("Snapshot grain: " + __SNAPSHOT_GRAIN)
+
+__FULL_REFRESH = __FULL_REFRESH.strip().upper()
+__SNAPSHOT_START_DATE = __SNAPSHOT_START_DATE.strip()
+__ZORDER_BY_COLUMNS = __ZORDER_BY_COLUMNS.strip()
+
+dfHistory = spark.table(__SOURCE_DATABASE + "." + __SOURCE_TABLE)
+for requiredColumn in ["__StartDatetimeUTC", "__EndDatetimeUTC"]:
+    if requiredColumn not in dfHistory.columns:
+        raise Exception("Source table is not SCD2 history table. Missing column: " + requiredColumn)
+
+# The last snapshot was built while its period was still open, so rebuild starts from it
+targetExists = DeltaTable.isDeltaTable(spark, __TARGET_PATH)
+firstSnapshotDate = None
+if targetExists and __FULL_REFRESH != "TRUE":
+    firstSnapshotDate = spark.read.format("delta").load(__TARGET_PATH).selectExpr("MAX(`__SnapshotDate`)").collect()[0][0]
+    print("Last snapshot date: " + str(firstSnapshotDate))
+
+if firstSnapshotDate is None:
+    if __SNAPSHOT_START_DATE != "":
+        firstSnapshotDate = datetime.strptime(__SNAPSHOT_START_DATE, "%Y-%m-%d").date()
+    else:
+        firstVersionDatetimeUTC = dfHistory.selectExpr("MIN(`__StartDatetimeUTC`)").collect()[0][0]
+        if firstVersionDatetimeUTC is None:
+            print("Source table is empty")
+            dbutils.notebook.exit(True)
+        firstSnapshotDate = firstVersionDatetimeUTC.date()
+    firstSnapshotDate = getSnapshotDate(firstSnapshotDate)
+
+# Snapshot of the current period reflects the latest loaded versions and is completed by later runs
+lastSnapshotDate = getSnapshotDate(datetime.utcnow().date())
+snapshotDates = getSnapshotDates(firstSnapshotDate, lastSnapshotDate)
+print("Build " + str(len(snapshotDates)) + " snapshots: " + str(firstSnapshotDate) + " - " + str(lastSnapshotDate))
+
+# COMMAND ----------
+
+dfSnapshotDates = spark.createDataFrame(pd.DataFrame({ '__SnapshotDate': snapshotDates })) \
+                       .withColumn('__SnapshotEndDatetimeUTC', expr("CAST(DATE_ADD(`__SnapshotDate`, 1) AS timestamp)"))
+
+# Only versions that overlap the rebuilt snapshots are read. Version is valid at end of snapshot date when it started before and ends at or after it
+firstSnapshotEndDatetimeUTC = datetime.combine(firstSnapshotDate + timedelta(days = 1), datetime.min.time())
+lastSnapshotEndDatetimeUTC = datetime.combine(lastSnapshotDate + timedelta(days = 1), datetime.min.time())
+dfVersions = dfHistory.where((col("__EndDatetimeUTC") >= firstSnapshotEndDatetimeUTC) & (col("__StartDatetimeUTC") < lastSnapshotEndDatetimeUTC))
+if "__Current" in dfVersions.columns:
+    dfVersions = dfVersions.drop("__Current")
+
+dfSnapshots = dfVersions.alias("v").join(
+    broadcast(dfSnapshotDates.alias("d")),
+    expr("v.`__StartDatetimeUTC` < d.`__SnapshotEndDatetimeUTC` AND v.`__EndDatetimeUTC` >= d.`__SnapshotEndDatetimeUTC`")
+).select("d.`__SnapshotDate`", "v.*")
+
+spark.sql("CREATE DATABASE IF NOT EXISTS " + __TARGET_DATABASE)
+
+if not targetExists:
+    print("Initial table creation")
+    dfSnapshots.write.format("delta") \
+               .option("path", __TARGET_PATH) \
+               .partitionBy("__SnapshotDate") \
+               .saveAsTable(__TARGET_DATABASE + "." + __TARGET_TABLE)
+else:
+    # Rebuilt snapshot partitions are replaced in single commit, older snapshots are not touched
+    print("Replace snapshots since " + str(firstSnapshotDate))
+    dfSnapshots.write.format("delta") \
+               .mode("overwrite") \
+               .option("replaceWhere", "`__SnapshotDate` >= '" + str(firstSnapshotDate) + "'") \
+               .option("mergeSchema", "true") \
+               .save(__TARGET_PATH)
+
+# COMMAND ----------
+
+print('Optimize snapshot delta: ' + __TARGET_PATH)
+if __ZORDER_BY_COLUMNS != "":
+    spark.sql("OPTIMIZE delta.`" + __TARGET_PATH + "` WHERE `__SnapshotDate` >= '" + str(firstSnapshotDate) + "' ZORDER BY (" + __ZORDER_BY_COLUMNS + ")")
+else:
+    spark.sql("OPTIMIZE delta.`" + __TARGET_PATH + "` WHERE `__SnapshotDate` >= '" + str(firstSnapshotDate) + "'")
+
+# COMMAND ----------
+
+# Return success
+dbutils.notebook.exit(True)
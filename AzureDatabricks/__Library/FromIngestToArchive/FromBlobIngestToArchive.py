@@ -25,6 +25,15 @@ try:
         __ARCHIVE_LOG_PATH = dbutils.widgets.get("ARCHIVE_LOG_PATH")
     except:
         print("Using default archive log path: " + __ARCHIVE_LOG_PATH)
+  
+    # Optional: Maintenance mode of archive log. Use "AUTO", "ALWAYS" or "NONE"
+    # AUTO = OPTIMIZE only when small files have accumulated, ALWAYS = OPTIMIZE on every run
+    # NONE = no OPTIMIZE, archive log is maintained by System/DeltaMaintenance notebook
+    __MAINTENANCE_MODE = "AUTO"
+    try:
+        __MAINTENANCE_MODE = dbutils.widgets.get("MAINTENANCE_MODE")
+    except:
+        print("Using default maintenance mode: " + __MAINTENANCE_MODE)
 except:
     raise Exception("Required parameter(s) missing")
 
@@ -55,6 +64,11 @@ __ARCHIVE_TABLE_FULLY_QUALIEFIED_NAME = "`" + __ARCHIVE_TARGET_DATABASE + "`.`"
 __ARCHIVE_PATH = "abfss://archive@" + __DATA_LAKE_NAME + ".dfs.core.windows.net/" + __ARCHIVE_PATH
 __ARCHIVE_LOG_PATH = "abfss://archive@" + __DATA_LAKE_NAME + ".dfs.core.windows.net/" + __ARCHIVE_LOG_PATH
 
+# Maintenance thresholds of MAINTENANCE_MODE = AUTO
+__MAINTENANCE_MODE = __MAINTENANCE_MODE.strip().upper()
+__MAINTENANCE_MIN_FILES = 50                    # Optimize when archive log has at least this many files ...
+__MAINTENANCE_SMALL_FILE_SIZE = 33554432        # ... and average file size is below 32 MB
+
 # Source blob storage authentication
 __BLOB_STORAGE_ACCOUNT = dbutils.secrets.get(scope = __SECRET_SCOPE, key = __SECRET_NAME_BLOB_ACCOUNT)
 __BLOB_STORAGE_KEY = dbutils.secrets.get(scope = __SECRET_SCOPE, key = __SECRET_NAME_BLOB_ACCOUNT_KEY)
@@ -79,6 +93,25 @@ spark.conf.set("fs.azure.account.oauth2.client.endpoint." + __DATA_LAKE_NAME + "
 
 # COMMAND ----------
 
+def isMaintenanceDue(tablePath):
+    # Archive log grows by small commits. AUTO optimizes when small files have accumulated instead of on every run
+    if __MAINTENANCE_MODE == "ALWAYS":
+        return True
+    if __MAINTENANCE_MODE == "NONE":
+        print("Maintenance is skipped by maintenance mode")
+        return False
+    
+    tableDetail = spark.sql("DESCRIBE DETAIL delta.`" + tablePath + "`").collect()[0]
+    numFiles = tableDetail["numFiles"] or 0
+    averageFileSize = (tableDetail["sizeInBytes"] or 0) / numFiles if numFiles > 0 else 0
+    if numFiles >= __MAINTENANCE_MIN_FILES and averageFileSize < __MAINTENANCE_SMALL_FILE_SIZE:
+        return True
+    
+    print("Maintenance is not due: " + str(numFiles) + " files, average file size " + str(int(averageFileSize)) + " bytes")
+    return False
+
+# COMMAND ----------
+
 def archiveFile(file, archivePath):
     archiveLogEntry = []
     
@@ -180,7 +213,8 @@ if archiveLogs:
   
     # 4. Optimize archive log
     print('Optimize archive log: ' + __ARCHIVE_LOG_PATH)
-    spark.sql('OPTIMIZE delta.`' + __ARCHIVE_LOG_PATH + '`').display()
+    if isMaintenanceDue(__ARCHIVE_LOG_PATH):
+        spark.sql('OPTIMIZE delta.`' + __ARCHIVE_LOG_PATH + '`').display()
 
 # COMMAND ----------
 
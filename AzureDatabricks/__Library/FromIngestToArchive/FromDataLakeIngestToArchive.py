@@ -22,6 +22,15 @@ try:
         __ARCHIVE_LOG_PATH = dbutils.widgets.get("ARCHIVE_LOG_PATH")
     except:
         print("Using default archive log path: " + __ARCHIVE_LOG_PATH)
+  
+    # Optional: Maintenance mode of archive log. Use "AUTO", "ALWAYS" or "NONE"
+    # AUTO = OPTIMIZE only when small files have accumulated, ALWAYS = OPTIMIZE on every run
+    # NONE = no OPTIMIZE, archive log is maintained by System/DeltaMaintenance notebook
+    __MAINTENANCE_MODE = "AUTO"
+    try:
+        __MAINTENANCE_MODE = dbutils.widgets.get("MAINTENANCE_MODE")
+    except:
+        print("Using default maintenance mode: " + __MAINTENANCE_MODE)
 except:
     raise Exception("Required parameter(s) missing")
 
@@ -51,6 +60,11 @@ __INGEST_PATH = "abfss://ingest@" + __DATA_LAKE_NAME + ".dfs.core.windows.net/"
 __ARCHIVE_PATH = "abfss://archive@" + __DATA_LAKE_NAME + ".dfs.core.windows.net/" + __ARCHIVE_PATH
 __ARCHIVE_LOG_PATH = "abfss://archive@" + __DATA_LAKE_NAME + ".dfs.core.windows.net/" + __ARCHIVE_LOG_PATH
 
+# Maintenance thresholds of MAINTENANCE_MODE = AUTO
+__MAINTENANCE_MODE = __MAINTENANCE_MODE.strip().upper()
+__MAINTENANCE_MIN_FILES = 50                    # Optimize when archive log has at least this many files ...
+__MAINTENANCE_SMALL_FILE_SIZE = 33554432        # ... and average file size is below 32 MB
+
 # In Spark 3.1, loading and saving of timestamps from/to parquet files fails if the timestamps are before 1900-01-01 00:00:00Z, and loaded (saved) as the INT96 type. 
 # In Spark 3.0, the actions don’t fail but might lead to shifting of the input timestamps due to rebasing from/to Julian to/from Proleptic Gregorian calendar. 
 # To restore the behavior before Spark 3.1, you can set spark.sql.parquet.int96RebaseModeInRead or/and spark.sql.legacy.parquet.int96RebaseModeInWrite to LEGACY.
@@ -66,6 +80,25 @@ spark.conf.set("fs.azure.account.oauth2.client.endpoint." + __DATA_LAKE_NAME + "
 
 # COMMAND ----------
 
+def isMaintenanceDue(tablePath):
+    # Archive log grows by small commits. AUTO optimizes when small files have accumulated instead of on every run
+    if __MAINTENANCE_MODE == "ALWAYS":
+        return True
+    if __MAINTENANCE_MODE == "NONE":
+        print("Maintenance is skipped by maintenance mode")
+        return False
+    
+    tableDetail = spark.sql("DESCRIBE DETAIL delta.`" + tablePath + "`").collect()[0]
+    numFiles = tableDetail["numFiles"] or 0
+    averageFileSize = (tableDetail["sizeInBytes"] or 0) / numFiles if numFiles > 0 else 0
+    if numFiles >= __MAINTENANCE_MIN_FILES and averageFileSize < __MAINTENANCE_SMALL_FILE_SIZE:
+        return True
+    
+    print("Maintenance is not due: " + str(numFiles) + " files, average file size " + str(int(averageFileSize)) + " bytes")
+    return False
+
+# COMMAND ----------
+
 def archiveFile(file, archivePath):
     archiveLogEntry = []
     
@@ -167,7 +200,8 @@ if archiveLogs:
   
     # 4. Optimize archive log
     print('Optimize archive log: ' + __ARCHIVE_LOG_PATH)
-    spark.sql('OPTIMIZE delta.`' + __ARCHIVE_LOG_PATH + '`').display()   
+    if isMaintenanceDue(__ARCHIVE_LOG_PATH):
+        spark.sql('OPTIMIZE delta.`' + __ARCHIVE_LOG_PATH + '`').display()
 
 # COMMAND ----------
 
@@ -0,0 +1,326 @@
+# Databricks notebook source
+# DBTITLE 1,Information
+# MAGIC %md
+# MAGIC Delta table maintenance
+# MAGIC
+# MAGIC Decides per table from Delta table statistics and history whether OPTIMIZE (with Z-order), VACUUM or log checkpoint is required and executes required operations within maintenance window and time budget.
+# MAGIC Intended to be scheduled e.g. nightly when loaders are executed with MAINTENANCE_MODE = NONE or AUTO.
+# MAGIC
+# MAGIC Required additional libraries:
+# MAGIC - None
+
+# COMMAND ----------
+
+from datetime import datetime, timedelta
+from delta.tables import DeltaTable
+from pyspark.sql.functions import col, expr, lit, row_number
+from pyspark.sql.window import Window
+import pandas as pd
+import time
+import json
+
+# Configuration
+__SECRET_SCOPE = "KeyVault"
+__SECRET_NAME_DATA_LAKE_APP_CLIENT_ID = "App-databricks-id"
+__SECRET_NAME_DATA_LAKE_APP_CLIENT_SECRET = "App-databricks-secret"
+__SECRET_NAME_DATA_LAKE_APP_CLIENT_TENANT_ID = "App-databricks-tenant-id"
+__DATA_LAKE_NAME = dbutils.secrets.get(scope = __SECRET_SCOPE, key = "Storage-Name")
+
+# Data lake authentication
+spark.conf.set("fs.azure.account.auth.type." + __DATA_LAKE_NAME + ".dfs.core.windows.net", "OAuth")
+spark.conf.set("fs.azure.account.oauth.provider.type." + __DATA_LAKE_NAME + ".dfs.core.windows.net", "org.apache.hadoop.fs.azurebfs.oauth2.ClientCredsTokenProvider")
+spark.conf.set("fs.azure.account.oauth2.client.id." + __DATA_LAKE_NAME + ".dfs.core.windows.net", dbutils.secrets.get(scope = __SECRET_SCOPE, key = __SECRET_NAME_DATA_LAKE_APP_CLIENT_ID))
+spark.conf.set("fs.azure.account.oauth2.client.secret." + __DATA_LAKE_NAME + ".dfs.core.windows.net", dbutils.secrets.get(scope = __SECRET_SCOPE, key = __SECRET_NAME_DATA_LAKE_APP_CLIENT_SECRET))
+spark.conf.set("fs.azure.account.oauth2.client.endpoint." + __DATA_LAKE_NAME + ".dfs.core.windows.net", "https://login.microsoftonline.com/" + dbutils.secrets.get(scope = __SECRET_SCOPE, key = __SECRET_NAME_DATA_LAKE_APP_CLIENT_TENANT_ID) + "/oauth2/token")
+
+# Tables to maintain. All Delta tables of the databases and Delta tables in the paths are included
+databases = []
+databases.append('Qivada_ADA')
+
+tablePaths = []
+# tablePaths.append('abfss://datahub@' + __DATA_LAKE_NAME + '.dfs.core.windows.net/analytics/datalake/crm/account/log/processDatetime/')
+
+ignoreTableNameStartsWith = []
+
+# Maintenance window (UTC) and time budget. No new operation is started outside window or after budget is used
+maintenanceWindowStartUTC = "00:00"
+maintenanceWindowEndUTC = "23:59"
+maintenanceBudgetMinutes = 120
+
+# OPTIMIZE thresholds
+smallFileSizeBytes = 33554432          # 32 MB. File smaller than this is considered small
+optimizeMinSmallFiles = 50             # Optimize when at least this many small files exist ...
+optimizeMinSmallFileRatio = 0.3        # ... and small files are at least this ratio of all files
+optimizeMaxRewrittenRowRatio = 0.2     # Optimize when rows updated or deleted since last OPTIMIZE exceed this ratio of table rows
+
+# VACUUM thresholds
+vacuumIntervalHours = 168              # Vacuum when previous VACUUM is older than this
+vacuumRetainHours = 168                # Retention of removed files. Must cover longest running reader and time travel need
+
+# Log checkpoint threshold
+checkpointMaxCommits = 100             # Checkpoint when more commits exist after the last checkpoint
+
+maintenanceLogs = []
+
+isDryRun: bool = True
+
+# COMMAND ----------
+
+def convert_size_bytes(size_bytes):
+    """
+    Converts a size in bytes to a human readable string using SI units.
+    """
+    import math
+    import sys
+
+    if size_bytes is None:
+        return "0B"
+
+    if not isinstance(size_bytes, int):
+        size_bytes = sys.getsizeof(size_bytes)
+
+    if size_bytes == 0:
+        return "0B"
+
+    size_name = ("B", "KB", "MB", "GB", "TB", "PB", "EB", "ZB", "YB")
+    i = int(math.floor(math.log(size_bytes, 1024)))
+    p = math.pow(1024, i)
+    s = round(size_bytes / p, 2)
+    return "%s %s" % (s, size_name[i])
+
+# COMMAND ----------
+
+def getActiveFiles(tablePath, version, lastCheckpoint):
+    """
+    Returns data files of Delta table version with size and row count from add and remove actions of Delta log. Data files are not read.
+    """
+    logPath = tablePath.rstrip("/") + "/_delta_log/"
+    deletionVectorSchema = "deletionVector: STRUCT<storageType: STRING, pathOrInlineDv: STRING, offset: INT, cardinality: BIGINT>"
+    actionSchema = "add STRUCT<path: STRING, size: BIGINT, stats: STRING, " + deletionVectorSchema + ">, remove STRUCT<path: STRING, " + deletionVectorSchema + ">"
+
+    # Checkpoint holds the files of its version. Commits after it add and remove files
+    checkpointVersion = -1
+    dfActions = None
+    if lastCheckpoint is not None:
+        if "v2Checkpoint" in lastCheckpoint:
+            raise Exception("V2 checkpoint is not supported")
+        checkpointVersion = int(lastCheckpoint["version"])
+        if lastCheckpoint.get("parts"):
+            checkpointPaths = [logPath + "{version:020d}.checkpoint.{part:010d}.{parts:010d}.parquet".format(version = checkpointVersion, part = part, parts = int(lastCheckpoint["parts"])) for part in range(1, int(lastCheckpoint["parts"]) + 1)]
+        else:
+            checkpointPaths = [logPath + "{version:020d}.checkpoint.parquet".format(version = checkpointVersion)]
+        dfActions = spark.read.schema(actionSchema).parquet(*checkpointPaths) \
+                         .where("add IS NOT NULL") \
+                         .withColumn("Version", lit(checkpointVersion))
+
+    commitPaths = [logPath + "{version:020d}.json".format(version = commitVersion) for commitVersion in range(checkpointVersion + 1, version + 1)]
+    if commitPaths:
+        dfCommits = spark.read.schema(actionSchema).json(commitPaths) \
+                         .withColumn("Version", expr("CAST(substring_index(_metadata.file_name, '.', 1) AS long)"))
+        dfActions = dfCommits if dfActions is None else dfActions.unionByName(dfCommits)
+
+    # File is identified by path and deletion vector. The last action of file decides whether it is part of the version
+    fileKey = "concat_ws('|', {action}.path, {action}.deletionVector.storageType, {action}.deletionVector.pathOrInlineDv, CAST({action}.deletionVector.offset AS string))"
+    dfAdds = dfActions.where("add IS NOT NULL") \
+                      .selectExpr("Version", fileKey.format(action = "add") + " AS FileKey", "TRUE AS IsAdded", "add.size AS FileSize", \
+                                  "CAST(get_json_object(add.stats, '$.numRecords') AS long) - COALESCE(add.deletionVector.cardinality, 0) AS NumRecords")
+    dfRemoves = dfActions.where("remove IS NOT NULL") \
+                         .selectExpr("Version", fileKey.format(action = "remove") + " AS FileKey", "FALSE AS IsAdded", "CAST(NULL AS long) AS FileSize", "CAST(NULL AS long) AS NumRecords")
+
+    return dfAdds.unionByName(dfRemoves) \
+                 .withColumn("ActionNumber", row_number().over(Window.partitionBy("FileKey").orderBy(col("Version").desc()))) \
+                 .where("ActionNumber = 1 AND IsAdded") \
+                 .select("FileSize", "NumRecords")
+
+# COMMAND ----------
+
+def getTableStatistics(tablePath):
+    """
+    Collects file size histogram, row counts and history based statistics of Delta table.
+    """
+    tableDetail = spark.sql("DESCRIBE DETAIL delta.`{path}`".format(path = tablePath)).collect()[0].asDict()
+
+    # History since the last OPTIMIZE and the last VACUUM
+    history = spark.sql("DESCRIBE HISTORY delta.`{path}`".format(path = tablePath)).select("version", "timestamp", "operation", "operationMetrics").collect()
+    currentVersion = max(row.version for row in history)
+    lastOptimizeVersion = max([row.version for row in history if row.operation == "OPTIMIZE"], default = -1)
+    lastVacuumTimestamp = max([row.timestamp for row in history if row.operation in ["VACUUM END", "VACUUM START"]], default = None)
+
+    rewrittenRows = 0
+    for row in history:
+        if row.version > lastOptimizeVersion and row.operationMetrics:
+            for metricName in ["numTargetRowsUpdated", "numTargetRowsDeleted", "numUpdatedRows", "numDeletedRows"]:
+                rewrittenRows += int(row.operationMetrics.get(metricName, 0) or 0)
+
+    # Commits after the last checkpoint
+    lastCheckpoint = None
+    lastCheckpointVersion = -1
+    try:
+        lastCheckpoint = json.loads(dbutils.fs.head(tablePath.rstrip("/") + "/_delta_log/_last_checkpoint"))
+        lastCheckpointVersion = int(lastCheckpoint["version"])
+    except Exception:
+        pass
+
+    # File count, size histogram and row count from file statistics in Delta log, aggregated on cluster into single row
+    histogramBins = [("< 1 MB", 0, 1048576), ("1 - 8 MB", 1048576, 8388608), ("8 - 32 MB", 8388608, 33554432), ("32 - 128 MB", 33554432, 134217728), ("128 MB - 1 GB", 134217728, 1073741824), (">= 1 GB", 1073741824, None)]
+    fileStatistics = getActiveFiles(tablePath, currentVersion, lastCheckpoint).agg(
+        expr("COUNT(1)").alias("NumFiles"),
+        expr("COALESCE(SUM(CASE WHEN FileSize < {size} THEN 1 ELSE 0 END), 0)".format(size = smallFileSizeBytes)).alias("NumSmallFiles"),
+        expr("COALESCE(SUM(NumRecords), 0)").alias("NumRecords"),
+        *[expr("COALESCE(SUM(CASE WHEN FileSize >= {lower}{upper} THEN 1 ELSE 0 END), 0)".format(lower = lower, upper = "" if upper is None else " AND FileSize < " + str(upper))).alias("Bin" + str(binIndex)) for binIndex, (label, lower, upper) in enumerate(histogramBins)]
+    ).collect()[0]
+    histogram = { label: fileStatistics["Bin" + str(binIndex)] for binIndex, (label, lower, upper) in enumerate(histogramBins) }
+
+    numFiles = fileStatistics["NumFiles"]
+    numSmallFiles = fileStatistics["NumSmallFiles"]
+    numRecords = fileStatistics["NumRecords"]
+
+    return {
+        'NumFiles': numFiles,
+        'NumSmallFiles': numSmallFiles,
+        'SmallFileRatio': (numSmallFiles / numFiles) if numFiles else 0,
+        'SizeInBytes': int(tableDetail["sizeInBytes"] or 0),
+        'NumRecords': numRecords,
+        'RewrittenRowRatio': (rewrittenRows / numRecords) if numRecords else 0,
+        'FileSizeHistogram': histogram,
+        'LastVacuumTimestamp': lastVacuumTimestamp,
+        'CommitsSinceCheckpoint': currentVersion - lastCheckpointVersion,
+        'ClusteringColumns': tableDetail.get("clusteringColumns") or [],
+        'ZOrderByColumns': (tableDetail.get("properties") or {}).get("ada.zOrderByColumns", "")
+    }
+
+# COMMAND ----------
+
+def getMaintenanceOperations(statistics):
+    """
+    Decides required maintenance operations with reasons and priority.
+    """
+    operations = []
+
+    if statistics['NumSmallFiles'] >= optimizeMinSmallFiles and statistics['SmallFileRatio'] >= optimizeMinSmallFileRatio:
+        operations.append(('OPTIMIZE', '{files} small files ({ratio:.0%})'.format(files = statistics['NumSmallFiles'], ratio = statistics['SmallFileRatio'])))
+    elif statistics['RewrittenRowRatio'] >= optimizeMaxRewrittenRowRatio:
+        operations.append(('OPTIMIZE', '{ratio:.0%} rows rewritten since last optimize'.format(ratio = statistics['RewrittenRowRatio'])))
+
+    if statistics['LastVacuumTimestamp'] is None or statistics['LastVacuumTimestamp'] < datetime.utcnow() - timedelta(hours = vacuumIntervalHours):
+        operations.append(('VACUUM', 'last vacuum {timestamp}'.format(timestamp = statistics['LastVacuumTimestamp'])))
+
+    if statistics['CommitsSinceCheckpoint'] > checkpointMaxCommits:
+        operations.append(('CHECKPOINT', '{commits} commits since last checkpoint'.format(commits = statistics['CommitsSinceCheckpoint'])))
+
+    return operations
+
+# COMMAND ----------
+
+def executeMaintenanceOperation(tablePath, operation, statistics):
+    """
+    Executes single maintenance operation against Delta table.
+    """
+    if operation == 'OPTIMIZE':
+        if statistics['ClusteringColumns']:
+            # Liquid clustered table clusters on OPTIMIZE
+            spark.sql("OPTIMIZE delta.`{path}`".format(path = tablePath))
+        elif statistics['ZOrderByColumns'] != "":
+            spark.sql("OPTIMIZE delta.`{path}` ZORDER BY ({columns})".format(path = tablePath, columns = statistics['ZOrderByColumns']))
+        else:
+            spark.sql("OPTIMIZE delta.`{path}`".format(path = tablePath))
+    elif operation == 'VACUUM':
+        spark.sql("VACUUM delta.`{path}` RETAIN {hours} HOURS".format(path = tablePath, hours = vacuumRetainHours))
+    elif operation == 'CHECKPOINT':
+        try:
+            deltaLog = spark._jvm.com.databricks.sql.transaction.tahoe.DeltaLog.forTable(spark._jsparkSession, tablePath)
+        except Exception:
+            deltaLog = spark._jvm.org.apache.spark.sql.delta.DeltaLog.forTable(spark._jsparkSession, tablePath)
+        deltaLog.checkpoint()
+
+# COMMAND ----------
+
+def isWithinMaintenanceWindow(startTime):
+    """
+    Checks that current time is within maintenance window and time budget is not used.
+    """
+    currentTime = datetime.utcnow().strftime("%H:%M")
+    if maintenanceWindowStartUTC <= maintenanceWindowEndUTC:
+        isWithinWindow = maintenanceWindowStartUTC <= currentTime <= maintenanceWindowEndUTC
+    else:
+        # Window over midnight
+        isWithinWindow = currentTime >= maintenanceWindowStartUTC or currentTime <= maintenanceWindowEndUTC
+
+    return isWithinWindow and (time.time() - startTime) < maintenanceBudgetMinutes * 60
+
+# COMMAND ----------
+
+# Collect Delta tables
+maintenanceTablePaths = list(tablePaths)
+for database in databases:
+    for table in spark.catalog.listTables(database):
+        if table.tableType == 'VIEW' or any(table.name.startswith(tableFilter) for tableFilter in ignoreTableNameStartsWith):
+            continue
+        try:
+            tableDetail = spark.sql("DESCRIBE DETAIL `{database}`.`{table}`".format(database = database, table = table.name)).collect()[0]
+            if tableDetail.format == 'delta' and tableDetail.location not in maintenanceTablePaths:
+                maintenanceTablePaths.append(tableDetail.location)
+        except Exception as e:
+            print('> Could not describe table `{database}`.`{table}`: {message}'.format(database = database, table = table.name, message = e))
+
+# Decide operations per table
+maintenanceOperations = []
+for tablePath in maintenanceTablePaths:
+    print('Analyze table: {path}'.format(path = tablePath))
+    try:
+        statistics = getTableStatistics(tablePath)
+    except Exception as e:
+        print('> Could not analyze table: {message}'.format(message = e))
+        continue
+
+    print('> Files: {files}, small files: {smallFiles}, size: {size}, rewritten rows: {ratio:.0%}'.format(files = statistics['NumFiles'], smallFiles = statistics['NumSmallFiles'], size = convert_size_bytes(statistics['SizeInBytes']), ratio = statistics['RewrittenRowRatio']))
+    print('> File size histogram: {histogram}'.format(histogram = statistics['FileSizeHistogram']))
+
+    for operation, reason in getMaintenanceOperations(statistics):
+        print('> {operation}: {reason}'.format(operation = operation, reason = reason))
+        # Tables with most small files and rewritten rows are maintained first
+        priority = statistics['NumSmallFiles'] + statistics['RewrittenRowRatio'] * 100
+        maintenanceOperations.append((priority, tablePath, operation, reason, statistics))
+
+if isDryRun:
+    print('')
+    print('NOTE! Maintenance is configured as dry run. Operations are not executed')
+
+# Execute operations within window and budget
+startTime = time.time()
+for priority, tablePath, operation, reason, statistics in sorted(maintenanceOperations, key = lambda x: -x[0]):
+    maintenanceLog = {
+        'MaintenanceDatetimeUTC': datetime.utcnow(),
+        'TablePath': tablePath,
+        'Operation': operation,
+        'Reason': reason,
+        'NumFiles': statistics['NumFiles'],
+        'NumSmallFiles': statistics['NumSmallFiles'],
+        'SizeInBytes': statistics['SizeInBytes'],
+        'Status': 'Planned',
+        'DurationSeconds': 0.0
+    }
+
+    if not isDryRun:
+        if not isWithinMaintenanceWindow(startTime):
+            maintenanceLog['Status'] = 'Skipped: outside maintenance window or budget'
+        else:
+            print('{operation}: {path}'.format(operation = operation, path = tablePath))
+            operationStartTime = time.time()
+            try:
+                executeMaintenanceOperation(tablePath, operation, statistics)
+                maintenanceLog['Status'] = 'Succeeded'
+            except Exception as e:
+                print('> Failed: {message}'.format(message = e))
+                maintenanceLog['Status'] = 'Failed: {message}'.format(message = str(e)[:500])
+            maintenanceLog['DurationSeconds'] = round(time.time() - operationStartTime, 1)
+
+    maintenanceLogs.append(maintenanceLog)
+
+# COMMAND ----------
+
+if maintenanceLogs:
+    dfMaintenanceLogs = spark.createDataFrame(pd.DataFrame(maintenanceLogs))
+    display(dfMaintenanceLogs)
+else:
+    print('No maintenance required')
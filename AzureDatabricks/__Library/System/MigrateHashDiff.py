@@ -0,0 +1,151 @@
+# Databricks notebook source
+# DBTITLE 1,Information
+# MAGIC %md
+# MAGIC Hash diff migration
+# MAGIC
+# MAGIC One-time in-place conversion of __HashDiff column of data hub tables from SHA-256 hex string (HASH_DIFF_ALGORITHM = SHA256) to 32 byte binary (HASH_DIFF_ALGORITHM = SHA256_BINARY).
+# MAGIC Both algorithms calculate the same digest, so existing values are converted with unhex and no archive file is read again.
+# MAGIC After migration the loaders of the tables, and DATABRICKS_SCD1 sinks of FromArchiveToMultipleTargets, must be called with HASH_DIFF_ALGORITHM = SHA256_BINARY.
+# MAGIC
+# MAGIC Run when loaders of the tables are not running. Parent and child tables (JSON loaders with EXPLODE_ARRAYS) must be migrated together.
+# MAGIC Previous table version stays available for time travel and can be recovered with RESTORE TABLE ... TO VERSION AS OF until it is vacuumed.
+# MAGIC
+# MAGIC Required additional libraries:
+# MAGIC - None
+
+# COMMAND ----------
+
+from datetime import datetime
+from delta.tables import DeltaTable
+from pyspark.sql.functions import col, length, unhex
+import pandas as pd
+import time
+
+# Configuration
+__SECRET_SCOPE = "KeyVault"
+__SECRET_NAME_DATA_LAKE_APP_CLIENT_ID = "App-databricks-id"
+__SECRET_NAME_DATA_LAKE_APP_CLIENT_SECRET = "App-databricks-secret"
+__SECRET_NAME_DATA_LAKE_APP_CLIENT_TENANT_ID = "App-databricks-tenant-id"
+__DATA_LAKE_NAME = dbutils.secrets.get(scope = __SECRET_SCOPE, key = "Storage-Name")
+
+# Data lake authentication
+spark.conf.set("fs.azure.account.auth.type." + __DATA_LAKE_NAME + ".dfs.core.windows.net", "OAuth")
+spark.conf.set("fs.azure.account.oauth.provider.type." + __DATA_LAKE_NAME + ".dfs.core.windows.net", "org.apache.hadoop.fs.azurebfs.oauth2.ClientCredsTokenProvider")
+spark.conf.set("fs.azure.account.oauth2.client.id." + __DATA_LAKE_NAME + ".dfs.core.windows.net", dbutils.secrets.get(scope = __SECRET_SCOPE, key = __SECRET_NAME_DATA_LAKE_APP_CLIENT_ID))
+spark.conf.set("fs.azure.account.oauth2.client.secret." + __DATA_LAKE_NAME + ".dfs.core.windows.net", dbutils.secrets.get(scope = __SECRET_SCOPE, key = __SECRET_NAME_DATA_LAKE_APP_CLIENT_SECRET))
+spark.conf.set("fs.azure.account.oauth2.client.endpoint." + __DATA_LAKE_NAME + ".dfs.core.windows.net", "https://login.microsoftonline.com/" + dbutils.secrets.get(scope = __SECRET_SCOPE, key = __SECRET_NAME_DATA_LAKE_APP_CLIENT_TENANT_ID) + "/oauth2/token")
+
+# Tables to migrate. All Delta tables of the databases and Delta tables in the paths with string __HashDiff column are included
+databases = []
+databases.append('Qivada_ADA')
+
+tablePaths = []
+# tablePaths.append('abfss://datahub@' + __DATA_LAKE_NAME + '.dfs.core.windows.net/analytics/datahub/crm/account/data')
+
+ignoreTableNameStartsWith = []
+
+migrationLogs = []
+
+isDryRun: bool = True
+
+# COMMAND ----------
+
+def getMigrationCandidate(tablePath):
+    """
+    Checks that __HashDiff column of Delta table is SHA-256 hex string. Returns reason when table cannot be migrated.
+    """
+    dfTable = spark.read.format("delta").load(tablePath)
+    if "__HashDiff" not in dfTable.columns:
+        return "No __HashDiff column"
+
+    dataType = dfTable.schema["__HashDiff"].dataType.simpleString()
+    if dataType != "string":
+        return "__HashDiff data type is " + dataType
+
+    # Values other than 64 character hex strings would convert to null
+    numInvalidRows = dfTable.where(col("__HashDiff").isNotNull() & ((length(col("__HashDiff")) != 64) | unhex(col("__HashDiff")).isNull())).limit(1).count()
+    if numInvalidRows > 0:
+        return "__HashDiff contains values that are not SHA-256 hex strings"
+
+    return None
+
+# COMMAND ----------
+
+def migrateHashDiff(tablePath):
+    """
+    Rewrites Delta table with binary __HashDiff. Partitioning, column order and table properties are kept.
+    """
+    tableDetail = spark.sql("DESCRIBE DETAIL delta.`{path}`".format(path = tablePath)).collect()[0].asDict()
+
+    # Delta snapshot isolation allows overwriting table with its own converted data in single commit
+    dfTable = spark.read.format("delta").load(tablePath).withColumn("__HashDiff", unhex(col("__HashDiff")))
+    dfWriter = dfTable.write.format("delta").mode("overwrite").option("overwriteSchema", "true")
+    if tableDetail["partitionColumns"]:
+        dfWriter = dfWriter.partitionBy(*tableDetail["partitionColumns"])
+    dfWriter.save(tablePath)
+
+    return DeltaTable.forPath(spark, tablePath).history(1).select("version").collect()[0].version
+
+# COMMAND ----------
+
+# Collect Delta tables
+migrationTablePaths = list(tablePaths)
+for database in databases:
+    for table in spark.catalog.listTables(database):
+        if table.tableType == 'VIEW' or any(table.name.startswith(tableFilter) for tableFilter in ignoreTableNameStartsWith):
+            continue
+        try:
+            tableDetail = spark.sql("DESCRIBE DETAIL `{database}`.`{table}`".format(database = database, table = table.name)).collect()[0]
+            if tableDetail.format == 'delta' and tableDetail.location not in migrationTablePaths:
+                migrationTablePaths.append(tableDetail.location)
+        except Exception as e:
+            print('> Could not describe table `{database}`.`{table}`: {message}'.format(database = database, table = table.name, message = e))
+
+if isDryRun:
+    print('NOTE! Migration is configured as dry run. Tables are not rewritten')
+    print('')
+
+for tablePath in migrationTablePaths:
+    print('Analyze table: {path}'.format(path = tablePath))
+    try:
+        reason = getMigrationCandidate(tablePath)
+    except Exception as e:
+        print('> Could not analyze table: {message}'.format(message = e))
+        continue
+
+    if reason is not None:
+        # Process log tables etc. without __HashDiff are not reported
+        if reason != "No __HashDiff column":
+            print('> Skipped: {reason}'.format(reason = reason))
+            migrationLogs.append({ 'MigrationDatetimeUTC': datetime.utcnow(), 'TablePath': tablePath, 'PreviousVersion': None, 'Version': None, 'Status': 'Skipped: ' + reason, 'DurationSeconds': 0.0 })
+        continue
+
+    migrationLog = {
+        'MigrationDatetimeUTC': datetime.utcnow(),
+        'TablePath': tablePath,
+        'PreviousVersion': DeltaTable.forPath(spark, tablePath).history(1).select("version").collect()[0].version,
+        'Version': None,
+        'Status': 'Planned',
+        'DurationSeconds': 0.0
+    }
+
+    if not isDryRun:
+        print('Migrate __HashDiff: {path}'.format(path = tablePath))
+        migrationStartTime = time.time()
+        try:
+            migrationLog['Version'] = migrateHashDiff(tablePath)
+            migrationLog['Status'] = 'Succeeded'
+        except Exception as e:
+            print('> Failed: {message}'.format(message = e))
+            migrationLog['Status'] = 'Failed: {message}'.format(message = str(e)[:500])
+        migrationLog['DurationSeconds'] = round(time.time() - migrationStartTime, 1)
+
+    migrationLogs.append(migrationLog)
+
+# COMMAND ----------
+
+if migrationLogs:
+    dfMigrationLogs = spark.createDataFrame(pd.DataFrame(migrationLogs))
+    display(dfMigrationLogs)
+else:
+    print('No tables to migrate')